@@ -25,24 +25,100 @@
 #
 
 
+import time
+import_started = time.time()
+
 import requests
+import urllib3
 from flask import Flask, request, session, redirect
 import json
 import io
 import os
 import re
-from google.cloud import vision
-from google.cloud.vision import types
-from PIL import Image
+import threading
+import queue
+import hashlib
+import collections
+import contextlib
+import contextvars
+import atexit
+import importlib
+import sys
+from concurrent import futures
+from urllib.parse import urlsplit, urlunsplit
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then not reported
+    resource = None
 
 
 import logging
-logging.basicConfig(level=logging.DEBUG)
 
+import settings
 from settings import bot_id, bot_token, ngrok_url, webhook_id, webhook_name
 
+# Optional tuning settings, see settings_template.py
+worker_threads = getattr(settings, 'worker_threads', 4)
+job_queue_size = getattr(settings, 'job_queue_size', 100)
+result_cache_size = getattr(settings, 'result_cache_size', 1000)
+result_cache_ttl = getattr(settings, 'result_cache_ttl', 24 * 3600)
+result_cache_dir = getattr(settings, 'result_cache_dir', None)
+spark_api_url = getattr(settings, 'spark_api_url', 'https://api.ciscospark.com/v1')
+spark_timeout = getattr(settings, 'spark_timeout', 10)
+spark_retries = getattr(settings, 'spark_retries', 3)
+spark_backoff = getattr(settings, 'spark_backoff', 0.5)
+spark_pool_size = getattr(settings, 'spark_pool_size', 10)
+spark_max_message_bytes = getattr(settings, 'spark_max_message_bytes', 7439)
+spark_streaming_messages = getattr(settings, 'spark_streaming_messages', False)
+image_byte_budget = getattr(settings, 'image_byte_budget', 1024 * 1024)
+jpeg_quality = getattr(settings, 'jpeg_quality', 85)
+fast_resample_scale = getattr(settings, 'fast_resample_scale', 0.25)
+vision_batch_requests = getattr(settings, 'vision_batch_requests', True)
+vision_fanout_workers = getattr(settings, 'vision_fanout_workers', None)
+vision_timeout = getattr(settings, 'vision_timeout', 30)
+message_item_concurrency = getattr(settings, 'message_item_concurrency', 4)
+seen_messages_size = getattr(settings, 'seen_messages_size', 10000)
+seen_messages_ttl = getattr(settings, 'seen_messages_ttl', 3600)
+seen_messages_dir = getattr(settings, 'seen_messages_dir', None)
+message_details_ttl = getattr(settings, 'message_details_ttl', 60)
+url_max_bytes = getattr(settings, 'url_max_bytes', 20 * 1024 * 1024)
+url_timeout = getattr(settings, 'url_timeout', 10)
+file_max_bytes = getattr(settings, 'file_max_bytes', 50 * 1024 * 1024)
+image_max_pixels = getattr(settings, 'image_max_pixels', 50 * 1000 * 1000)
+image_memory_budget = getattr(settings, 'image_memory_budget', 512 * 1024 * 1024)
+default_features = tuple(getattr(settings, 'default_features',
+    ('web', 'text', 'faces', 'labels', 'landmarks', 'logos', 'macs')))
+room_profiles_path = getattr(settings, 'room_profiles_path', 'room_profiles.json')
+bot_name = getattr(settings, 'bot_name', 'GoogleVision')
+log_level = getattr(settings, 'log_level', 'INFO')
+ngrok_proto = getattr(settings, 'ngrok_proto', 'http')
+webhook_retries = getattr(settings, 'webhook_retries', 10)
+webhook_backoff = getattr(settings, 'webhook_backoff', 2.0)
+result_summary_items = getattr(settings, 'result_summary_items', None)
+feature_limits = getattr(settings, 'feature_limits', {
+    'web': {'max_results': 10, 'min_score': 0.0},
+    'text': {'max_results': 50, 'bounds': False},
+    'faces': {'max_results': 10, 'bounds': True},
+    'labels': {'max_results': 10, 'min_score': 0.5},
+    'landmarks': {'max_results': 5, 'min_score': 0.0},
+    'logos': {'max_results': 5, 'min_score': 0.0},
+})
+vision_rate = getattr(settings, 'vision_rate', 30)
+vision_burst = getattr(settings, 'vision_burst', 30)
+vision_max_concurrency = getattr(settings, 'vision_max_concurrency', 16)
+vision_quota_retries = getattr(settings, 'vision_quota_retries', 3)
+vision_quota_backoff = getattr(settings, 'vision_quota_backoff', 1.0)
+spark_rate = getattr(settings, 'spark_rate', None)
+spark_burst = getattr(settings, 'spark_burst', 10)
+spark_max_concurrency = getattr(settings, 'spark_max_concurrency', spark_pool_size)
+rate_limit_max_wait = getattr(settings, 'rate_limit_max_wait', 30)
+image_hash_distance = getattr(settings, 'image_hash_distance', None)
+image_hash_size = getattr(settings, 'image_hash_size', 100000)
+image_hash_path = getattr(settings, 'image_hash_path', None)
+
 image_is_in_Spark = False
-detect_macs = True
 filename = None
 
 base_img_width=1024
@@ -55,42 +131,589 @@ signature = "Hantzley Tauckoor - [\[Email\]](mailto:htauckoo@cisco.com) \
 project_info = "Liked this Bot? Want to contribute or create your own? See \
     the project on [GitHub](https://github.com/Hantzley/spark-bot-google-vision)"
 
+too_large_msg = "Ahoy! Thanks for sending me your image. However, it is too \
+    large for me to analyze."
+
 help_msg = "Hey there! The GoogleVision Bot is easy to use. \
     Simply post an image to the Spark room, and the Bot will tell you what it sees. \
     You can also post the URL of an image. \
     \n\nE.g. **_@GoogleVision image\-file_** or **_@GoogleVision_** **_image\-url_** \
     \n\nIf you are in a 1-1 Spark room with the Bot, you can post the image or image \
-    URL directly. Give it a try and send me your feedback.\n\nThank you,\n\n" + signature
+    URL directly. \
+    \n\nName the features you are interested in to only get those, e.g. **_@GoogleVision text macs image\-file_**. \
+    Features are **web**, **text**, **faces**, **labels**, **landmarks**, **logos** and **macs**. \
+    **_@GoogleVision profile text macs_** makes them the default for the room, **_@GoogleVision profile reset_** goes back to all features. \
+    Give it a try and send me your feedback.\n\nThank you,\n\n" + signature
+
+#################################### Startup ###################################
+
+# Time spent in each startup stage, in seconds, reported by /stats
+startup_timings = collections.OrderedDict()
+
+# times a startup stage for the startup report, and logs it once done as
+# stages running in the background or on first use end after the report
+@contextlib.contextmanager
+def startup_stage(stage):
+    started = time.time()
+    try:
+        yield
+    finally:
+        startup_timings[stage] = time.time() - started
+        logging.info("Startup stage %s took %.3fs", stage, startup_timings[stage])
+
+
+class LazyModule(object):
+    """Stands in for a module that is slow to import, importing it on first
+    use and timing the import for the startup report."""
+
+    def __init__(self, name):
+        self.__dict__['name'] = name
+        self.__dict__['module'] = None
+
+    def __getattr__(self, attribute):
+        module = self.__dict__['module']
+        if module is None:
+            # Imports are serialised by the import lock, the module is only loaded once
+            with startup_stage('import ' + self.name):
+                module = self.__dict__['module'] = importlib.import_module(self.name)
+        return getattr(module, attribute)
+
+# Google Vision and Pillow take a while to import, and are only needed once
+# the first image is analysed
+vision = LazyModule('google.cloud.vision')
+types = LazyModule('google.cloud.vision_v1.types')
+gax = LazyModule('google.gax')
+Image = LazyModule('PIL.Image')
+
+# sets up logging at log_level, see settings_template.py
+def configure_logging():
+    # Messages logged while importing set up a default handler already
+    logging.basicConfig(level=log_level, force=True)
+
+# logs how long each startup stage took
+def report_startup():
+    logging.info("Startup: %s", ', '.join(
+        '{} {:.3f}s'.format(stage, elapsed) for stage, elapsed in startup_timings.items()))
+
+################################################################################
+
+
+################################### Metrics ####################################
+
+class Metrics(object):
+    """Collects counters and latency histograms and renders them in the
+    Prometheus text format.
+
+    Gauges are read at render time from the collectors registered with
+    register(), each returning (name, labels, value) tuples.
+    """
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = collections.OrderedDict()
+        self.histograms = collections.OrderedDict()
+        self.collectors = []
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * len(self.buckets) + [0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    def register(self, collector):
+        self.collectors.append(collector)
+
+    def labels(self, labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"'))
+                              for name, value in labels) + '}'
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = [(key, list(value)) for key, value in self.histograms.items()]
+
+        for (name, labels), value in counters:
+            lines.append('{}_{}{} {}'.format(self.prefix, name, self.labels(labels), value))
+
+        for (name, labels), histogram in histograms:
+            for bound, count in zip(self.buckets, histogram):
+                bucket_labels = labels + (('le', repr(bound)),)
+                lines.append('{}_{}_bucket{} {}'.format(self.prefix, name, self.labels(bucket_labels), count))
+            lines.append('{}_{}_bucket{} {}'.format(self.prefix, name, self.labels(labels + (('le', '+Inf'),)), histogram[-2]))
+            lines.append('{}_{}_count{} {}'.format(self.prefix, name, self.labels(labels), histogram[-2]))
+            lines.append('{}_{}_sum{} {}'.format(self.prefix, name, self.labels(labels), histogram[-1]))
+
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                # Unknown or unlimited values have no sample
+                if value is None:
+                    continue
+                lines.append('{}_{}{} {}'.format(self.prefix, name, self.labels(sorted(labels.items())), value))
+
+        return '\n'.join(lines) + '\n'
+
+# Created for each worker process by init_worker()
+metrics = None
+
+class Trace(object):
+    """Message ID of the webhook handled by the current thread, or by the
+    current task in the asyncio pipeline of async_app.py, for log spans."""
+
+    def __init__(self):
+        self.var = contextvars.ContextVar('message_id', default='-')
+
+    @property
+    def message_id(self):
+        return self.var.get()
+
+    @message_id.setter
+    def message_id(self, value):
+        self.var.set(value)
+
+trace = Trace()
+
+# times a stage of the webhook processing, counting failed external calls
+@contextlib.contextmanager
+def timed(stage, dependency=None):
+    started = time.time()
+    try:
+        yield
+    except ImageTooLarge:
+        # The image posted is at fault, not the dependency
+        raise
+    except Exception:
+        if dependency:
+            metrics.inc('dependency_errors_total', dependency=dependency)
+        raise
+    finally:
+        elapsed = time.time() - started
+        metrics.observe('stage_seconds', elapsed, stage=stage)
+        logging.debug("[%s] %s took %.3fs", trace.message_id, stage, elapsed)
+
+################################################################################
+
+
+################################# Rate Limiting ################################
 
-def resize_image (filename, base_img_width):
-    img=Image.open(filename)
+class RateLimited(Exception):
+    """Raised when a call waited too long for its turn under the quota of an
+    external API."""
 
-    #Only resize if image width > base_img_width
-    if img.size[0] > base_img_width:
-        wpercent= (base_img_width / float(img.size[0]))
-        hsize = int((float(img.size[1]) * float(wpercent)))
-        img = img.resize((base_img_width, hsize), Image.ANTIALIAS)
 
-        #Save resized Image
-        new_filename = 'new_' + filename
-        img.save(new_filename)
+class RateLimiter(object):
+    """Keeps the calls to an external API within its quota.
 
-        #Remove old Image
-        os.remove(filename)
-        filename = 'new_' + filename
+    A token bucket lets rate calls per second through on average, in bursts
+    of up to burst calls (rate None means no limit), with at most limit
+    calls in flight. The limit adapts: it is halved when the API answers
+    that the quota is exhausted, and grows back by one after limit
+    successful calls, up to max_concurrency. Callers wait for their turn,
+    and their call is dropped with RateLimited after max_wait seconds.
+    """
+
+    def __init__(self, name, rate, burst, max_concurrency, max_wait):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.limit = self.max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.backed_off = 0.0
+        self.throttled = 0
+        self.dropped = 0
+        self.backoffs = 0
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        else:
+            self.tokens = self.burst
+        self.updated = now
+
+    # takes a turn if one is free and returns 0, else returns the seconds
+    # until the next token, or None when waiting for a call to end; called
+    # with the condition held
+    def take(self, now):
+        self.refill(now)
+        if self.in_flight >= self.limit:
+            return None
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.in_flight += 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    # counts a call waiting for its turn, once per call
+    def throttle(self):
+        self.throttled += 1
+        metrics.inc('rate_limited_total', api=self.name, outcome='throttled')
+
+    # counts a call dropped after max_wait, returns the error to raise
+    def drop(self):
+        self.dropped += 1
+        metrics.inc('rate_limited_total', api=self.name, outcome='dropped')
+        return RateLimited("{} call waited over {}s for its turn".format(self.name, self.max_wait))
+
+    # waits until the call may be made, release() must follow it
+    def acquire(self):
+        deadline = time.time() + self.max_wait
+        throttled = False
+        with self.condition:
+            while True:
+                now = time.time()
+                delay = self.take(now)
+                if delay == 0:
+                    return
+
+                if now >= deadline:
+                    raise self.drop()
+                if not throttled:
+                    throttled = True
+                    self.throttle()
+
+                self.condition.wait(min(deadline - now, delay or deadline - now))
+
+    # ends a call, exhausted tells that the API refused it over its quota
+    def release(self, exhausted=False):
+        with self.condition:
+            self.in_flight -= 1
+            now = time.time()
+            if exhausted:
+                # Calls in flight together fail together, back off once for them
+                if now - self.backed_off >= 1.0:
+                    self.limit = max(1, self.limit // 2)
+                    self.successes = 0
+                    self.backed_off = now
+                    self.backoffs += 1
+                    metrics.inc('rate_limit_backoffs_total', api=self.name)
+                    logging.warning("%s quota exhausted, %d calls in flight at most", self.name, self.limit)
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'limit': self.limit,
+                'in_flight': self.in_flight,
+                'throttled': self.throttled,
+                'dropped': self.dropped,
+                'backoffs': self.backoffs,
+            }
+
+################################################################################
+
+
+################################# Memory Limits ################################
+
+class ImageTooLarge(ValueError):
+    """Raised when an image is larger than the download or pixel limits."""
 
-    #return final image name
-    return filename
+
+class ImageBuffer(object):
+    """Collects the chunks of a streamed image download in memory.
+
+    write() returns False as soon as the first bytes show that the download
+    is not an image, and raises ImageTooLarge once it exceeds max_bytes, so
+    that neither is downloaded in full. A Content-Length over max_bytes is
+    refused before the first chunk.
+    """
+
+    def __init__(self, max_bytes, length=None):
+        self.max_bytes = max_bytes
+        if int(length or 0) > max_bytes:
+            raise ImageTooLarge("{} bytes, more than {}".format(length, max_bytes))
+        self.buffer = io.BytesIO()
+        self.head = b''
+
+    def write(self, chunk):
+        self.buffer.write(chunk)
+        if len(self.head) < 16:
+            self.head += chunk[:16 - len(self.head)]
+            if len(self.head) == 16 and sniff_image_type(self.head) is None:
+                return False
+        if self.buffer.tell() > self.max_bytes:
+            raise ImageTooLarge("more than {} bytes".format(self.max_bytes))
+        return True
+
+    # returns the downloaded image, None if it is not an image
+    def getvalue(self):
+        if sniff_image_type(self.head) is None:
+            return None
+        return self.buffer.getvalue()
+
+
+class MemoryBudget(object):
+    """Bounds the memory held at once by the images being decoded and
+    resized by the threads of a worker process.
+
+    reserve() waits, in turn, until the bytes asked for fit in the budget
+    (limit None means no limit). A reservation larger than the whole budget
+    runs once nothing else is reserved, rather than never.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.condition = threading.Condition()
+        self.waiters = collections.deque()
+        self.reserved = 0
+        self.peak = 0
+        self.queued = 0
+        self.total_wait = 0.0
+
+    def fits(self, size):
+        return self.limit is None or not self.reserved or self.reserved + size <= self.limit
+
+    @contextlib.contextmanager
+    def reserve(self, size):
+        started = time.time()
+        with self.condition:
+            if self.waiters or not self.fits(size):
+                # Wait behind the reservations already queued, in order
+                waiter = object()
+                self.waiters.append(waiter)
+                self.queued += 1
+                while self.waiters[0] is not waiter or not self.fits(size):
+                    self.condition.wait()
+                self.waiters.popleft()
+                self.condition.notify_all()
+                wait = time.time() - started
+                self.total_wait += wait
+                metrics.observe('stage_seconds', wait, stage='memory_wait')
+            self.reserved += size
+            self.peak = max(self.peak, self.reserved)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.reserved -= size
+                self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'limit': self.limit,
+                'reserved': self.reserved,
+                'peak': self.peak,
+                'waiting': len(self.waiters),
+                'queued': self.queued,
+                'total_wait': self.total_wait,
+            }
+
+# peak resident memory of the process so far, in bytes, None where unknown
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+################################################################################
+
+
+# computes the 64 bit difference hash of an image, which stays the same or
+# nearly so when the image is scaled or re-encoded
+def dhash(img):
+    pixels = list(img.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = value << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+# bytes taken by an opened image once decoded, at its draft size if any
+def decoded_size(img):
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+# drops the transparency of an image for JPEG encoding, over a white
+# background so that dark text on a transparent one stays readable
+def flatten_image(img):
+    if img.mode in ('RGB', 'L'):
+        return img
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+# resizes the encoded image in content, returns the encoded result
+def resize_image (content, base_img_width, timings=None, hashes=None):
+    """Downscales an encoded image to base_img_width and re-encodes it within
+    image_byte_budget bytes.
+
+    Images that are already narrow and small enough are returned untouched,
+    only decoded, at a reduced size, when their hash is needed. The time
+    spent decoding, resizing and encoding is stored in timings and the
+    difference hash of the image in hashes['dhash'] when dicts are given.
+
+    Images of more than image_max_pixels pixels raise ImageTooLarge before
+    being decoded, and decoding waits for room in the image_memory budget.
+    """
+    if timings is None:
+        timings = {}
+    timings.update(decode=0.0, resize=0.0, encode=0.0)
+
+    # Opening an image only parses its header
+    try:
+        img=Image.open(io.BytesIO(content))
+    except Image.DecompressionBombError as error:
+        raise ImageTooLarge(str(error))
+    img_format = img.format
+    width, height = img.size
+    if image_max_pixels and width * height > image_max_pixels:
+        raise ImageTooLarge("{}x{} pixels, more than {}".format(width, height, image_max_pixels))
+
+    if width <= base_img_width and len(content) <= image_byte_budget:
+        if hashes is not None:
+            img.draft('L', (64, 64))
+            with image_memory.reserve(decoded_size(img)):
+                hashes['dhash'] = dhash(img)
+        return content
+
+    #Let the JPEG decoder downscale by a power of two while decoding
+    target_size = (base_img_width, max(1, int(height * base_img_width / float(width))))
+    if width > base_img_width:
+        img.draft(img.mode, target_size)
+
+    # Decoding holds the whole bitmap, wait for room in the memory budget
+    with image_memory.reserve(decoded_size(img) + len(content)):
+        started = time.time()
+        img.load()
+        timings['decode'] = time.time() - started
+
+        #Only resize if image width > base_img_width
+        started = time.time()
+        if img.size[0] > base_img_width:
+            scale = base_img_width / float(img.size[0])
+            resample = Image.LANCZOS if scale >= fast_resample_scale else Image.BILINEAR
+            img = img.resize(target_size, resample)
+        if hashes is not None:
+            hashes['dhash'] = dhash(img)
+        timings['resize'] = time.time() - started
+
+        #Encode resized Image in its original format, falling back to JPEG
+        #with decreasing quality until it fits in the byte budget
+        started = time.time()
+        buffer = io.BytesIO()
+        if img_format != 'JPEG':
+            img.save(buffer, format=img_format)
+
+        if img_format == 'JPEG' or buffer.tell() > image_byte_budget:
+            img = flatten_image(img)
+            for quality in (jpeg_quality, 75, 60, 45):
+                buffer = io.BytesIO()
+                img.save(buffer, format='JPEG', quality=min(quality, jpeg_quality))
+                if buffer.tell() <= image_byte_budget:
+                    break
+        content = buffer.getvalue()
+        timings['encode'] = time.time() - started
+
+        logging.debug("Image %s %sx%s -> %sx%s, %d bytes, decode %.3fs, resize %.3fs, encode %.3fs",
+            img_format, width, height, img.size[0], img.size[1], len(content),
+            timings['decode'], timings['resize'], timings['encode'])
+        for stage in ('decode', 'resize', 'encode'):
+            metrics.observe('stage_seconds', timings[stage], stage='image_' + stage)
+
+    #return final image content
+    return content
+
+# Leading bytes of the image formats supported by Google Vision
+image_signatures = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+    (b'\x00\x00\x01\x00', 'ico'),
+)
+
+# tells the image type from the first bytes of a file, None if not an image
+def sniff_image_type(head):
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    for signature, image_type in image_signatures:
+        if head.startswith(signature):
+            return image_type
+    return None
+
+# reads the streamed body of an image download, None if it is not an image
+def read_image(response, max_bytes, deadline=None):
+    """Reads an image chunk by chunk, see ImageBuffer.
+
+    Raises ImageTooLarge once the image exceeds max_bytes. Gives up and
+    returns None as soon as the first bytes show it is not an image, or
+    once the deadline has passed.
+    """
+    try:
+        image = ImageBuffer(max_bytes, response.headers.get('Content-Length'))
+        for chunk in response.iter_content(64 * 1024):
+            if not image.write(chunk):
+                logging.info("Not fetching %s, not an image", response.url)
+                return None
+            if deadline is not None and time.time() > deadline:
+                logging.info("Not fetching %s, took longer than %ss", response.url, url_timeout)
+                return None
+        return image.getvalue()
+    finally:
+        response.close()
+
+# tells whether the headers of a download announce an image
+def is_image_type(headers):
+    return 'image' in headers.get('Content-Type', '')
+
+# downloads the image an URL points to, None if it is not an acceptable image
+def fetch_image(url):
+    """Fetches an image in a single streamed GET.
+
+    The download is abandoned as soon as the first bytes show it is not an
+    image, or once it exceeds url_timeout seconds. Images larger than
+    url_max_bytes raise ImageTooLarge.
+    """
+    deadline = time.time() + url_timeout
+    response = web.get(url, stream=True, timeout=url_timeout)
+    if response.status_code != 200:
+        logging.info("Fetching %s failed: %s", url, response.status_code)
+        response.close()
+        return None
+    return read_image(response, url_max_bytes, deadline)
 
 # get ngrok tunnels information
 def get_ngrok_tunnels(ngrok_url):
     headers = {'cache-control': "no-cache"}
-    response = requests.request("GET", ngrok_url, headers=headers)
-    tunnels = response.json()
-    return {
-        'public_http_url' : tunnels['tunnels'][0]['public_url'],
-        'public_https_url' : tunnels['tunnels'][1]['public_url']
-    }
+    response = requests.request("GET", ngrok_url, headers=headers, timeout=5)
+    tunnels = {}
+    # Tunnels are listed in no particular order, and not always both
+    for tunnel in response.json().get('tunnels', []):
+        tunnels.setdefault('public_{}_url'.format(tunnel.get('proto')), tunnel['public_url'])
+    return tunnels
 
 # set spark headers
 def set_headers(access_token):
@@ -101,612 +724,1883 @@ def set_headers(access_token):
         }
     return (spark_header)
 
-# update webhook with updated ngrok tunnel information
-def update_webhook (the_headers,webhook_name,webhook_id,targetUrl):
-    url = "https://api.ciscospark.com/v1/webhooks/" + webhook_id
-    payload = "{\n\t\"name\": \"" + webhook_name + "\",\n\t\"targetUrl\": \"" + targetUrl + "\"\n}"
-    response = requests.request("PUT", url, data=payload, headers=the_headers)
-    return response.status_code
-
-# posts a message to the room
-def post_message_to_room(the_header,roomId,msg):
-    message = {"roomId":roomId,"markdown":msg}
-    uri = 'https://api.ciscospark.com/v1/messages'
-    resp = requests.post(uri, json=message, headers=the_header)
-
-# posts a messages in list format to the room
-def post_messages_to_room(the_header,roomId,messages):
-    for item in messages:
-        message = {"roomId":roomId,"markdown":item}
-        uri = 'https://api.ciscospark.com/v1/messages'
-        resp = requests.post(uri, json=message, headers=the_header)
-
-# get message details
-def get_message_details(the_header,msgId):
-    uri = 'https://api.ciscospark.com/v1/messages/' + msgId
-    resp = requests.get(uri, headers=the_header)
-    return resp.text
 
+# whether a Spark call failed before its request could be sent
+def connect_failed(error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
 
-############################ Google Vision Functions ###########################
 
-# [START def_detect_faces]
-def detect_faces(path):
-    """Detects faces in an image."""
-    client = vision.ImageAnnotatorClient()
+class SparkClient(object):
+    """Calls the Spark REST API over a pooled keep-alive session.
 
-    # [START migration_face_detection]
-    # [START migration_image_file]
-    with io.open(path, 'rb') as image_file:
-        content = image_file.read()
-
-    image = types.Image(content=content)
-    # [END migration_image_file]
-
-    response = client.face_detection(image=image)
-    faces = response.face_annotations
+    Requests time out after timeout seconds. Connection errors, timeouts,
+    5xx answers and 429 answers are retried up to retries times, waiting for
+    the Retry-After delay given by Spark or else an exponential backoff.
+    POSTs are only retried when Spark cannot have handled them: when the
+    connection could not be made, on 429 and on 503. Retry-After delays are
+    capped at rate_limit_max_wait seconds. Every attempt waits for its turn with the
+    RateLimiter given as limiter.
+    """
 
-    lines = []
+    retry_statuses = (429, 502, 503, 504)
+    post_retry_statuses = (429, 503)
+
+    def __init__(self, access_token, base_url, timeout, retries, pool_size, limiter=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.limiter = limiter
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update(set_headers(access_token))
+
+    def retry_delay(self, response, attempt):
+        if response is not None:
+            try:
+                return min(float(response.headers['Retry-After']), rate_limit_max_wait)
+            except (KeyError, ValueError):
+                pass
+        return spark_backoff * (2 ** attempt)
+
+    def request(self, method, url, stage='spark_request', **kwargs):
+        if not url.startswith('http'):
+            url = self.base_url + url
+        kwargs.setdefault('timeout', self.timeout)
+
+        # A POST timing out or losing its connection may still have posted
+        # its message, retrying it would post it twice
+        post = method == 'POST'
+        retry_statuses = self.post_retry_statuses if post else self.retry_statuses
+
+        attempt = 0
+        while True:
+            response = None
+            if self.limiter:
+                self.limiter.acquire()
+            try:
+                with timed(stage, 'spark'):
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if attempt >= self.retries or (post and not connect_failed(error)):
+                    raise
+            else:
+                if response.status_code >= 400:
+                    metrics.inc('dependency_errors_total', dependency='spark')
+                if response.status_code not in retry_statuses or attempt >= self.retries:
+                    return response
+            finally:
+                if self.limiter:
+                    self.limiter.release(response is not None and response.status_code == 429)
+
+            delay = self.retry_delay(response, attempt)
+            logging.warning("Spark %s %s failed, retrying in %.1fs", method, url, delay)
+            if response is not None:
+                # Hand a streamed connection back to the pool
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    # update webhook with updated ngrok tunnel information
+    def update_webhook(self, webhook_name, webhook_id, targetUrl):
+        payload = {"name": webhook_name, "targetUrl": targetUrl}
+        response = self.request("PUT", "/webhooks/" + webhook_id, 'spark_update_webhook', json=payload)
+        return response.status_code
+
+    # posts a message to the room
+    def post_message(self, roomId, msg):
+        message = {"roomId":roomId,"markdown":msg}
+        resp = self.request("POST", "/messages", 'spark_post_message', json=message)
+        if resp.status_code != 200:
+            logging.warning("Posting message to room failed: %s %s", resp.status_code, resp.text)
+        return resp
+
+    # posts a messages in list format to the room
+    def post_messages(self, roomId, messages):
+        for item in messages:
+            self.post_message(roomId, item)
+
+    # replaces the text of a message posted by the bot
+    def edit_message(self, msgId, roomId, msg):
+        message = {"roomId":roomId,"markdown":msg}
+        resp = self.request("PUT", "/messages/" + msgId, 'spark_edit_message', json=message)
+        if resp.status_code != 200:
+            logging.warning("Editing message failed: %s %s", resp.status_code, resp.text)
+        return resp
+
+    # get message details
+    def get_message_details(self, msgId):
+        resp = self.request("GET", "/messages/" + msgId, 'spark_message_details')
+        return resp.text
+
+    # starts downloading a file posted to a room, its body is read with
+    # read_image
+    def download(self, url):
+        return self.request("GET", url, 'download', stream=True)
+
+
+# joins the lines of each non-empty result section into a message text
+def format_sections(sections):
+    return ['\n'.join(lines) for lines in sections if len(lines) > 1]
+
+
+class MessageComposer(object):
+    """Packs result sections into as few Spark messages as the markdown size
+    limit allows, keeping them in the order they were added.
+
+    By default messages are only posted when full or on close(). In
+    streaming mode the current message is posted with its first section and
+    edited each time another section is appended to it.
+    """
 
-    # Names of likelihood from google.cloud.vision.enums
-    likelihood_name = ('UNKNOWN', 'VERY_UNLIKELY', 'UNLIKELY', 'POSSIBLE',
-                       'LIKELY', 'VERY_LIKELY')
-    lines.append('\n**Faces:**')
+    separator = '\n\n'
+
+    def __init__(self, spark, roomId, max_bytes, streaming=False):
+        self.spark = spark
+        self.roomId = roomId
+        self.max_bytes = max_bytes
+        self.streaming = streaming
+        self.parts = []
+        self.size = 0
+        self.message_id = None
+
+    def split(self, text):
+        # Break a text that cannot fit in one message at line boundaries
+        if len(text.encode('utf-8')) <= self.max_bytes:
+            return [text]
+
+        chunks = []
+        chunk = ''
+        for line in text.split('\n'):
+            while len(line.encode('utf-8')) > self.max_bytes:
+                if chunk:
+                    chunks.append(chunk)
+                    chunk = ''
+                cut = line.encode('utf-8')[:self.max_bytes].decode('utf-8', 'ignore')
+                chunks.append(cut)
+                line = line[len(cut):]
+            candidate = chunk + '\n' + line if chunk else line
+            if len(candidate.encode('utf-8')) > self.max_bytes:
+                chunks.append(chunk)
+                candidate = line
+            chunk = candidate
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def add(self, text):
+        for chunk in self.split(text):
+            size = len(chunk.encode('utf-8'))
+            if self.parts and self.size + len(self.separator) + size > self.max_bytes:
+                self.flush()
+
+            if self.parts:
+                self.size += len(self.separator)
+            self.parts.append(chunk)
+            self.size += size
+
+            if self.streaming:
+                self.publish()
+
+    # adds each non-empty result section of an analysis
+    def add_sections(self, sections):
+        for text in format_sections(sections):
+            self.add(text)
+
+    def publish(self):
+        text = self.separator.join(self.parts)
+        if self.message_id is None:
+            resp = self.spark.post_message(self.roomId, text)
+            if resp.status_code == 200:
+                self.message_id = resp.json().get('id')
+        else:
+            self.spark.edit_message(self.message_id, self.roomId, text)
 
-    for face in faces:
-        lines.append('* anger: {}'.format(likelihood_name[face.anger_likelihood]))
-        lines.append('* joy: {}'.format(likelihood_name[face.joy_likelihood]))
-        lines.append('* surprise: {}'.format(likelihood_name[face.surprise_likelihood]))
+    def flush(self):
+        if self.parts and not self.streaming:
+            self.publish()
+        self.parts = []
+        self.size = 0
+        self.message_id = None
 
-        vertices = (['({},{})'.format(vertex.x, vertex.y)
-                    for vertex in face.bounding_poly.vertices])
+    def close(self):
+        self.flush()
 
-        lines.append('* face bounds: {}'.format(','.join(vertices)))
 
-    return lines
-    # [END migration_face_detection]
-# [END def_detect_faces]
+############################ Google Vision Functions ###########################
 
+# Analysis features, in the order results are posted
+all_features = ('web', 'text', 'faces', 'labels', 'landmarks', 'logos', 'macs')
 
-# [START def_detect_faces_uri]
-def detect_faces_uri(uri):
-    """Detects faces in the file located in Google Cloud Storage or the web."""
-    client = vision.ImageAnnotatorClient()
-    # [START migration_image_uri]
-    image = types.Image()
-    image.source.image_uri = uri
-    # [END migration_image_uri]
+# Features whose results stay the same when an image is rescaled or
+# re-encoded; text, and the MAC addresses read from it, may not
+similar_features = ('web', 'labels', 'landmarks', 'logos')
 
-    response = client.face_detection(image=image)
-    faces = response.face_annotations
+# Features requested from Google Vision, MAC addresses come from the text
+vision_features = ('web', 'text', 'faces', 'labels', 'landmarks', 'logos')
 
-    lines = []
+# Vision feature type of each feature, by name so Vision is not imported
+feature_types = {
+    'web': 'WEB_DETECTION',
+    'text': 'TEXT_DETECTION',
+    'faces': 'FACE_DETECTION',
+    'labels': 'LABEL_DETECTION',
+    'landmarks': 'LANDMARK_DETECTION',
+    'logos': 'LOGO_DETECTION',
+}
 
-    # Names of likelihood from google.cloud.vision.enums
-    likelihood_name = ('UNKNOWN', 'VERY_UNLIKELY', 'UNLIKELY', 'POSSIBLE',
-                       'LIKELY', 'VERY_LIKELY')
-    lines.append('\n**Faces:**')
+# Names of likelihood from google.cloud.vision.enums
+likelihood_name = ('UNKNOWN', 'VERY_UNLIKELY', 'UNLIKELY', 'POSSIBLE',
+                   'LIKELY', 'VERY_LIKELY')
 
-    for face in faces:
-        lines.append('* anger: {}'.format(likelihood_name[face.anger_likelihood]))
-        lines.append('* joy: {}'.format(likelihood_name[face.joy_likelihood]))
-        lines.append('* surprise: {}'.format(likelihood_name[face.surprise_likelihood]))
 
-        vertices = (['({},{})'.format(vertex.x, vertex.y)
-                    for vertex in face.bounding_poly.vertices])
+# loads an image file into a Vision image
+def load_image(path):
+    with io.open(path, 'rb') as image_file:
+        content = image_file.read()
 
-        lines.append('* face bounds: {}'.format(','.join(vertices)))
+    return types.Image(content=content)
 
-    return lines
-# [END def_detect_faces_uri]
+# points a Vision image to a file in Google Cloud Storage or on the web
+def load_image_uri(uri):
+    image = types.Image()
+    image.source.image_uri = uri
+    return image
 
+class VisionClientManager(object):
+    """Holds one ImageAnnotatorClient per worker process.
 
-# [START def_detect_labels]
-def detect_labels(path):
-    """Detects labels in the file."""
-    client = vision.ImageAnnotatorClient()
+    The client is created lazily on first use, shared by every thread of the
+    worker, and rebuilt after a fork or when a call on its channel fails.
+    """
 
-    # [START migration_label_detection]
-    with io.open(path, 'rb') as image_file:
-        content = image_file.read()
+    def __init__(self, factory=None):
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.client = None
+        self.pid = None
+        self.constructed = 0
+        self.reused = 0
+        self.resets = 0
+
+    def get(self):
+        with self.lock:
+            if self.client is None or self.pid != os.getpid():
+                factory = self.factory or vision.ImageAnnotatorClient
+                self.client = factory()
+                self.pid = os.getpid()
+                self.constructed += 1
+            else:
+                self.reused += 1
+            return self.client
+
+    def reset(self, client=None):
+        # Only drop the client if nobody has replaced it in the meantime
+        with self.lock:
+            if client is None or client is self.client:
+                self.client = None
+                self.resets += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'constructed': self.constructed,
+                'reused': self.reused,
+                'resets': self.resets,
+            }
+
+vision_clients = VisionClientManager()
+
+# reads an option of feature_limits for a feature, see settings_template.py
+def feature_limit(feature, option, default=None):
+    return feature_limits.get(feature, {}).get(option, default)
+
+# number of results to ask Vision for, 0 for its default. All the text is
+# always requested, MAC addresses are extracted from it
+def vision_max_results(feature):
+    if feature == 'text':
+        return 0
+    return feature_limit(feature, 'max_results') or 0
+
+# google.rpc.Code of the errors returned over the Vision quota
+resource_exhausted = 8
+
+# tells whether a failed Vision call was refused over the API quota
+def is_quota_error(error):
+    return getattr(error, 'code', None) == 429 or 'RESOURCE_EXHAUSTED' in str(error)
+
+# annotates an image with several features in a single Vision round trip
+def annotate_image(image, features=vision_features, deadline=None):
+    """Sends one multi-feature annotate request and returns its response."""
+    return annotate_images([image], features, deadline)[0]
+
+# annotates up to 16 images with several features in a single Vision call
+def annotate_images(images, features=vision_features, deadline=None):
+    """Sends one multi-image, multi-feature annotate request and returns
+    the response of each image, in order.
+
+    Calls wait for their turn with vision_limiter. A call refused over the
+    quota is retried up to vision_quota_retries times after an exponential
+    backoff, any other failed call drops the shared client and is retried
+    once on a fresh channel. With a deadline, a time.time() value, the RPC
+    is given the time left as its timeout and is not retried past it.
+    """
+    annotate_requests = [types.AnnotateImageRequest(
+        image=image,
+        features=[types.Feature(type=feature_types[feature], max_results=vision_max_results(feature))
+                  for feature in features])
+        for image in images]
+
+    failures = 0
+    quota_errors = 0
+    while True:
+        client = vision_clients.get()
+        responses = error = None
+        vision_limiter.acquire()
+        try:
+            options = None
+            if deadline is not None:
+                options = gax.CallOptions(timeout=max(0.0, deadline - time.time()))
+            with timed('vision_' + '_'.join(features), 'vision'):
+                responses = client.batch_annotate_images(annotate_requests, options=options).responses
+        except Exception as e:
+            error = e
+        if error is not None:
+            exhausted = is_quota_error(error)
+        else:
+            exhausted = any(response.error.code == resource_exhausted for response in responses)
+        vision_limiter.release(exhausted)
+
+        delay = vision_quota_backoff * (2 ** quota_errors)
+        expired = deadline is not None and time.time() + (delay if exhausted else 0) >= deadline
+        if exhausted and quota_errors < vision_quota_retries and not expired:
+            quota_errors += 1
+            logging.warning("Vision quota exhausted, retrying in %.1fs", delay)
+            time.sleep(delay)
+            continue
+        if error is None:
+            break
+        if exhausted:
+            raise error
+
+        vision_clients.reset(client)
+        failures += 1
+        if failures == 2 or expired:
+            raise error
+        logging.warning("Vision call failed, rebuilding client", exc_info=error)
+
+    for response in responses:
+        if response.error.message:
+            metrics.inc('dependency_errors_total', dependency='vision')
+            logging.warning("Vision annotate error: %s", response.error.message)
+
+    return responses
+
+
+# annotates an image with one Vision call per feature, all in flight at once
+def annotate_image_concurrently(image, features=vision_features, timeout=None):
+    """Runs a single-feature annotate request per feature in parallel and
+    merges the responses in feature order.
+
+    A feature whose call fails or takes longer than timeout seconds is left
+    out of the merged response, whose error then names it so the partial
+    result is not cached. Calls are given the time left as their RPC
+    timeout, and calls still queued at the deadline are cancelled.
+    """
+    if timeout is None:
+        timeout = vision_timeout
+    deadline = time.time() + timeout
+    message_id = trace.message_id
+
+    def annotate(feature):
+        trace.message_id = message_id
+        return annotate_image(image, (feature,), deadline)
+
+    pending = [(feature, vision_fanout.submit(annotate, feature)) for feature in features]
+
+    response = types.AnnotateImageResponse()
+    missing = []
+    for feature, future in pending:
+        try:
+            response.MergeFrom(future.result(max(0, deadline - time.time())))
+        except futures.TimeoutError:
+            future.cancel()
+            missing.append(feature)
+            logging.warning("Vision %s detection timed out after %ss", feature, timeout)
+        except Exception:
+            missing.append(feature)
+            logging.exception("Vision %s detection failed", feature)
+
+    if missing:
+        response.error.message = "Vision {} detection did not complete".format(', '.join(missing))
+    return response
+
+# MAC addresses written as aa:bb:cc:dd:ee:ff, aa-bb-cc-dd-ee-ff, abcd.abcd.abcd
+# or aabbccddeeff, not preceded or followed by more of the same notation
+mac_address_regex = re.compile(
+    r'(?<![0-9A-F])'
+    r'(?:(?P<separated>[0-9A-F]{1,2}(?:[:-][0-9A-F]{1,2}){5})'
+    r'|(?P<dotted>[0-9A-F]{4}\.[0-9A-F]{4}\.[0-9A-F]{4})'
+    r'|(?P<bare>[0-9A-F]{12}))'
+    r'(?![0-9A-F])(?![:.-][0-9A-F])', re.IGNORECASE)
+
+mac_separator_regex = re.compile(r'[:-]')
+
+# A whole group of hex digits and a separator right before a match, e.g. the
+# "00:" of seven groups, make it part of a longer sequence; the "AC:" ending
+# "MAC:" does not, as the group is not a word of its own
+mac_preceding_group_regex = re.compile(r'(?:^|[^0-9A-Z])[0-9A-F]{1,4}[:.-]$', re.IGNORECASE)
+
+def extract_mac_addresses(text):
+    """Returns the distinct MAC addresses found in text, in order of
+    appearance and normalized to the aa:bb:cc:dd:ee:ff notation."""
+    mac_addresses = []
+    seen = set()
 
-    image = types.Image(content=content)
+    for match in mac_address_regex.finditer(text):
+        if mac_preceding_group_regex.search(text, max(0, match.start() - 6), match.start()):
+            continue
+        if match.group('separated'):
+            digits = ''.join(group.zfill(2) for group in mac_separator_regex.split(match.group('separated')))
+        else:
+            digits = match.group(0).replace('.', '')
 
-    response = client.label_detection(image=image)
-    labels = response.label_annotations
+        digits = digits.lower()
+        mac = ':'.join(digits[i:i + 2] for i in range(0, 12, 2))
+        if mac not in seen:
+            seen.add(mac)
+            mac_addresses.append(mac)
 
-    lines = []
-    lines.append('\n**Labels:**')
+    return mac_addresses
 
-    for label in labels:
-        lines.append('* ' + label.description)
 
-    return lines
-    # [END migration_label_detection]
-# [END def_detect_labels]
+# analyses an image with a single Vision call
+def analyze_image(image, features=default_features):
+    """Returns the AnalysisResult of an image for the given features.
 
+    Only the Vision features needed are requested. MAC addresses are
+    extracted from the same text annotations as the OCR section, so they do
+    not cost an additional Vision call.
+    """
+    requested = vision_request_features(features)
+    if not requested:
+        return AnalysisResult()
 
-# [START def_detect_labels_uri]
-def detect_labels_uri(uri):
-    """Detects labels in the file located in Google Cloud Storage or on the
-    Web."""
-    client = vision.ImageAnnotatorClient()
-    image = types.Image()
-    image.source.image_uri = uri
+    if vision_batch_requests:
+        response = annotate_image(image, requested)
+    else:
+        response = annotate_image_concurrently(image, requested)
 
-    response = client.label_detection(image=image)
-    labels = response.label_annotations
+    return parse_response(response, features)
 
-    lines = []
-    lines.append('\n**Labels:**')
+# lists the Vision features needed to analyse features, MAC addresses are
+# extracted from the text annotations
+def vision_request_features(features):
+    return [feature for feature in vision_features
+            if feature in features or (feature == 'text' and 'macs' in features)]
 
-    for label in labels:
-        lines.append('* ' + label.description)
 
-    return lines
-# [END def_detect_labels_uri]
+def detect_faces(path):
+    """Detects faces in an image."""
+    return render_faces(parse_faces(annotate_image(load_image(path), ('faces',))))
 
 
-# [START def_detect_landmarks]
-def detect_landmarks(path):
-    """Detects landmarks in the file."""
-    client = vision.ImageAnnotatorClient()
+def detect_faces_uri(uri):
+    """Detects faces in the file located in Google Cloud Storage or the web."""
+    return render_faces(parse_faces(annotate_image(load_image_uri(uri), ('faces',))))
 
-    # [START migration_landmark_detection]
-    with io.open(path, 'rb') as image_file:
-        content = image_file.read()
 
-    image = types.Image(content=content)
+def detect_labels(path):
+    """Detects labels in the file."""
+    return render_labels(parse_labels(annotate_image(load_image(path), ('labels',))))
 
-    response = client.landmark_detection(image=image)
-    landmarks = response.landmark_annotations
 
-    lines = []
-    lines.append('\n**Landmarks:**')
+def detect_labels_uri(uri):
+    """Detects labels in the file located in Google Cloud Storage or on the
+    Web."""
+    return render_labels(parse_labels(annotate_image(load_image_uri(uri), ('labels',))))
 
-    for landmark in landmarks:
-        lines.append('* ' + landmark.description)
 
-    return lines
-    # [END migration_landmark_detection]
-# [END def_detect_landmarks]
+def detect_landmarks(path):
+    """Detects landmarks in the file."""
+    return render_landmarks(parse_landmarks(annotate_image(load_image(path), ('landmarks',))))
 
 
-# [START def_detect_landmarks_uri]
 def detect_landmarks_uri(uri):
     """Detects landmarks in the file located in Google Cloud Storage or on the
     Web."""
-    client = vision.ImageAnnotatorClient()
-    image = types.Image()
-    image.source.image_uri = uri
-
-    response = client.landmark_detection(image=image)
-    landmarks = response.landmark_annotations
-
-    lines = []
-    lines.append('\n**Landmarks:**')
-
-    for landmark in landmarks:
-        lines.append('* ' + landmark.description)
-
-    return lines
-# [END def_detect_landmarks_uri]
+    return render_landmarks(parse_landmarks(annotate_image(load_image_uri(uri), ('landmarks',))))
 
 
-# [START def_detect_logos]
 def detect_logos(path):
     """Detects logos in the file."""
-    client = vision.ImageAnnotatorClient()
+    return render_logos(parse_logos(annotate_image(load_image(path), ('logos',))))
 
-    # [START migration_logo_detection]
-    with io.open(path, 'rb') as image_file:
-        content = image_file.read()
 
-    image = types.Image(content=content)
-
-    response = client.logo_detection(image=image)
-    logos = response.logo_annotations
-
-    lines = []
-    lines.append('\n**Logos:**')
-
-    for logo in logos:
-        lines.append('* ' + logo.description)
-
-    return lines
-    # [END migration_logo_detection]
-# [END def_detect_logos]
-
-
-# [START def_detect_logos_uri]
 def detect_logos_uri(uri):
     """Detects logos in the file located in Google Cloud Storage or on the Web.
     """
-    client = vision.ImageAnnotatorClient()
-    image = types.Image()
-    image.source.image_uri = uri
+    return render_logos(parse_logos(annotate_image(load_image_uri(uri), ('logos',))))
 
-    response = client.logo_detection(image=image)
-    logos = response.logo_annotations
 
-    lines = []
-    lines.append('\n**Logos:**')
+def detect_text(path):
+    """Detects text in the file."""
+    return render_text(parse_text(annotate_image(load_image(path), ('text',))))
 
-    for logo in logos:
-        lines.append('* ' + logo.description)
 
-    return lines
-# [END def_detect_logos_uri]
+def detect_text_uri(uri):
+    """Detects text in the file located in Google Cloud Storage or on the Web.
+    """
+    return render_text(parse_text(annotate_image(load_image_uri(uri), ('text',))))
 
 
-# [START def_detect_text]
-def detect_text(path):
-    """Detects text in the file."""
-    client = vision.ImageAnnotatorClient()
+def detect_web(path):
+    """Detects web annotations given an image."""
+    return render_web(parse_web(annotate_image(load_image(path), ('web',))))
 
-    # [START migration_text_detection]
-    with io.open(path, 'rb') as image_file:
-        content = image_file.read()
 
-    image = types.Image(content=content)
+def detect_web_uri(uri):
+    """Detects web annotations in the file located in Google Cloud Storage."""
+    return render_web(parse_web(annotate_image(load_image_uri(uri), ('web',))))
 
-    response = client.text_detection(image=image)
-    texts = response.text_annotations
 
-    lines = []
-    lines.append('\n**Texts:**')
+def detect_mac_addresses(path):
+    """Detects MAC addresses in the image."""
+    return render_mac_addresses(parse_mac_addresses(annotate_image(load_image(path), ('text',))))
 
-    for text in texts:
-        lines.append('\n* "{}"'.format(text.description))
+################################################################################
 
-        vertices = (['({},{})'.format(vertex.x, vertex.y)
-                    for vertex in text.bounding_poly.vertices])
+################################# Analysis Results #############################
 
-        lines.append('* bounds: {}'.format(','.join(vertices)))
+class Record(object):
+    """Base of the slotted records holding analysis results.
 
-    return lines
-    # [END migration_text_detection]
-# [END def_detect_text]
+    Records are built positionally or by field name, and turned into plain
+    dicts, lists and numbers for caching and JSON. The converters in fields
+    rebuild nested records from their plain form.
+    """
 
+    __slots__ = ()
+    fields = {}
 
-# [START def_detect_text_uri]
-def detect_text_uri(uri):
-    """Detects text in the file located in Google Cloud Storage or on the Web.
-    """
-    client = vision.ImageAnnotatorClient()
-    image = types.Image()
-    image.source.image_uri = uri
+    def __init__(self, *args, **kwargs):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+        for name, value in kwargs.items():
+            setattr(self, name, value)
 
-    response = client.text_detection(image=image)
-    texts = response.text_annotations
+    def to_dict(self):
+        return dict((name, plain(getattr(self, name))) for name in self.__slots__)
 
-    lines = []
-    lines.append('\n**Texts:**')
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**dict((name, cls.fields.get(name, plain)(data[name])) for name in cls.__slots__))
 
-    for text in texts:
-        lines.append('\n* "{}"'.format(text.description))
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
 
-        vertices = (['({},{})'.format(vertex.x, vertex.y)
-                    for vertex in text.bounding_poly.vertices])
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
 
-        lines.append('* bounds: {}'.format(','.join(vertices)))
+# turns records and tuples into dicts and lists
+def plain(value):
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, (list, tuple)):
+        return [plain(item) for item in value]
+    return value
 
-    return lines
-# [END def_detect_text_uri]
+# converter rebuilding a list of records, None stays None
+def records_of(cls):
+    return lambda items: None if items is None else [cls.from_dict(item) for item in items]
 
+def bounds_of(points):
+    return None if points is None else [tuple(point) for point in points]
 
-# [START def_detect_web]
-def detect_web(path):
-    """Detects web annotations given an image."""
-    client = vision.ImageAnnotatorClient()
 
-    # [START migration_web_detection]
-    with io.open(path, 'rb') as image_file:
-        content = image_file.read()
+class Entity(Record):
+    """A label, landmark, logo or web entity with its confidence score."""
+    __slots__ = ('description', 'score')
 
-    image = types.Image(content=content)
 
-    response = client.web_detection(image=image)
-    notes = response.web_detection
+class Face(Record):
+    """The likelihood of some emotions on a face, and its bounding polygon."""
+    __slots__ = ('anger', 'joy', 'surprise', 'bounds')
+    fields = {'bounds': bounds_of}
 
-    lines = []
-    lines.append('\n**Web annotations:**')
 
-    if notes.pages_with_matching_images:
-        lines.append('\n{} Pages with matching images retrieved'.format(
-               len(notes.pages_with_matching_images)))
+class Text(Record):
+    """A piece of text detected in the image and its bounding polygon. The
+    first one holds all the text of the image."""
+    __slots__ = ('description', 'bounds')
+    fields = {'bounds': bounds_of}
 
-        for page in notes.pages_with_matching_images:
-            lines.append('* Url   : {}'.format(page.url))
 
-    if notes.full_matching_images:
-        lines.append ('\n{} Full Matches found: '.format(
-               len(notes.full_matching_images)))
+class WebDetection(Record):
+    """The URLs of pages and images matching the image, and the entities
+    found for it on the web."""
+    __slots__ = ('pages', 'full_matches', 'partial_matches', 'entities')
+    fields = {'entities': records_of(Entity)}
 
-        for image in notes.full_matching_images:
-            lines.append('* Url  : {}'.format(image.url))
 
-    if notes.partial_matching_images:
-        lines.append ('\n{} Partial Matches found: '.format(
-               len(notes.partial_matching_images)))
+class AnalysisResult(Record):
+    """The results of the features analysed in an image, None for the
+    features that were not requested. error holds the message of a Vision
+    error, in which case the results may be empty or partial."""
+    __slots__ = ('web', 'text', 'faces', 'labels', 'landmarks', 'logos', 'macs', 'error')
+    fields = {
+        'web': lambda web: None if web is None else WebDetection.from_dict(web),
+        'text': records_of(Text),
+        'faces': records_of(Face),
+        'labels': records_of(Entity),
+        'landmarks': records_of(Entity),
+        'logos': records_of(Entity),
+    }
 
-        for image in notes.partial_matching_images:
-            lines.append('* Url  : {}'.format(image.url))
+    def __init__(self, *args, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        Record.__init__(self, *args, **kwargs)
+
+# reads the bounding polygon of an annotation
+def vertices(bounding_poly):
+    return [(vertex.x, vertex.y) for vertex in bounding_poly.vertices]
+
+# reads the annotations of a feature scoring at least its min_score, up to
+# its max_results
+def parse_entities(feature, annotations):
+    min_score = feature_limit(feature, 'min_score', 0.0)
+    entities = [Entity(annotation.description, annotation.score)
+                for annotation in annotations if annotation.score >= min_score]
+    return entities[:feature_limit(feature, 'max_results')]
+
+def parse_faces(response):
+    """Reads the face annotations of a Vision response."""
+    bounds = feature_limit('faces', 'bounds', True)
+    return [Face(likelihood_name[face.anger_likelihood], likelihood_name[face.joy_likelihood],
+                 likelihood_name[face.surprise_likelihood],
+                 vertices(face.bounding_poly) if bounds else None)
+            for face in response.face_annotations[:feature_limit('faces', 'max_results')]]
+
+def parse_labels(response):
+    """Reads the label annotations of a Vision response."""
+    return parse_entities('labels', response.label_annotations)
+
+def parse_landmarks(response):
+    """Reads the landmark annotations of a Vision response."""
+    return parse_entities('landmarks', response.landmark_annotations)
+
+def parse_logos(response):
+    """Reads the logo annotations of a Vision response."""
+    return parse_entities('logos', response.logo_annotations)
+
+def parse_text(response):
+    """Reads the text annotations of a Vision response: all the text, then
+    up to max_results words."""
+    annotations = response.text_annotations
+    max_results = feature_limit('text', 'max_results')
+    if max_results is not None:
+        annotations = annotations[:max_results + 1]
+
+    bounds = feature_limit('text', 'bounds', True)
+    return [Text(text.description, vertices(text.bounding_poly) if bounds else None)
+            for text in annotations]
+
+def parse_web(response):
+    """Reads the web detection of a Vision response."""
+    notes = response.web_detection
+    max_results = feature_limit('web', 'max_results')
+    return WebDetection(
+        [page.url for page in notes.pages_with_matching_images[:max_results]],
+        [image.url for image in notes.full_matching_images[:max_results]],
+        [image.url for image in notes.partial_matching_images[:max_results]],
+        parse_entities('web', notes.web_entities))
+
+def parse_mac_addresses(response):
+    """Finds the MAC addresses in the text annotations of a Vision
+    response."""
+    # The first text annotation holds all the text detected in the image
+    if response.text_annotations:
+        return extract_mac_addresses(response.text_annotations[0].description)
+    return []
+
+
+# adds the lines of the first limit items, and how many were left out
+def add_items(lines, items, format_item, limit=None):
+    for item in items[:limit]:
+        format_item(lines, item)
+    if limit is not None and len(items) > limit:
+        lines.append('* ... {} more'.format(len(items) - limit))
+
+def format_bounds(bounds):
+    return ','.join('({},{})'.format(x, y) for x, y in bounds)
+
+def render_faces(faces, limit=None):
+    """Renders face results as Spark markdown lines."""
+    lines = []
+    lines.append('\n**Faces:**')
 
-    if notes.web_entities:
-        lines.append ('\n{} Web entities found: '.format(len(notes.web_entities)))
+    def add_face(lines, face):
+        lines.append('* anger: {}'.format(face.anger))
+        lines.append('* joy: {}'.format(face.joy))
+        lines.append('* surprise: {}'.format(face.surprise))
+        if face.bounds is not None:
+            lines.append('* face bounds: {}'.format(format_bounds(face.bounds)))
+    add_items(lines, faces, add_face, limit)
 
-        for entity in notes.web_entities:
-            lines.append('* Score      : {}'.format(entity.score))
-            lines.append('* Description: {}'.format(entity.description))
+    return lines
 
+# renders label, landmark or logo results as Spark markdown lines
+def render_entities(title, entities, limit=None):
+    lines = []
+    lines.append('\n**{}:**'.format(title))
+    add_items(lines, entities, lambda lines, entity: lines.append('* ' + entity.description), limit)
     return lines
-    # [END migration_web_detection]
-# [END def_detect_web]
 
+def render_labels(labels, limit=None):
+    """Renders label results as Spark markdown lines."""
+    return render_entities('Labels', labels, limit)
 
-# [START def_detect_web_uri]
-def detect_web_uri(uri):
-    """Detects web annotations in the file located in Google Cloud Storage."""
-    client = vision.ImageAnnotatorClient()
-    image = types.Image()
-    image.source.image_uri = uri
+def render_landmarks(landmarks, limit=None):
+    """Renders landmark results as Spark markdown lines."""
+    return render_entities('Landmarks', landmarks, limit)
 
-    response = client.web_detection(image=image)
-    notes = response.web_detection
+def render_logos(logos, limit=None):
+    """Renders logo results as Spark markdown lines."""
+    return render_entities('Logos', logos, limit)
 
+def render_text(texts, limit=None):
+    """Renders text results as Spark markdown lines."""
     lines = []
-    lines.append('\n**Web annotations:**')
+    lines.append('\n**Texts:**')
 
-    if notes.pages_with_matching_images:
-        lines.append('\n{} Pages with matching images retrieved'.format(
-               len(notes.pages_with_matching_images)))
+    def add_text(lines, text):
+        lines.append('\n* "{}"'.format(text.description))
+        if text.bounds is not None:
+            lines.append('* bounds: {}'.format(format_bounds(text.bounds)))
+    add_items(lines, texts, add_text, limit)
 
-        for page in notes.pages_with_matching_images:
-            lines.append('* Url   : {}'.format(page.url))
+    return lines
 
-    if notes.full_matching_images:
-        lines.append ('\n{} Full Matches found: '.format(
-               len(notes.full_matching_images)))
+def render_web(web, limit=None):
+    """Renders web detection results as Spark markdown lines."""
+    lines = []
+    lines.append('\n**Web annotations:**')
 
-        for image in notes.full_matching_images:
-            lines.append('* Url  : {}'.format(image.url))
+    add_url = lambda lines, url: lines.append('* Url  : {}'.format(url))
+    if web.pages:
+        lines.append('\n{} Pages with matching images retrieved'.format(len(web.pages)))
+        add_items(lines, web.pages, lambda lines, url: lines.append('* Url   : {}'.format(url)), limit)
 
-    if notes.partial_matching_images:
-        lines.append ('\n{} Partial Matches found: '.format(
-               len(notes.partial_matching_images)))
+    if web.full_matches:
+        lines.append('\n{} Full Matches found: '.format(len(web.full_matches)))
+        add_items(lines, web.full_matches, add_url, limit)
 
-        for image in notes.partial_matching_images:
-            lines.append('* Url  : {}'.format(image.url))
+    if web.partial_matches:
+        lines.append('\n{} Partial Matches found: '.format(len(web.partial_matches)))
+        add_items(lines, web.partial_matches, add_url, limit)
 
-    if notes.web_entities:
-        lines.append ('\n{} Web entities found: '.format(len(notes.web_entities)))
+    if web.entities:
+        lines.append('\n{} Web entities found: '.format(len(web.entities)))
 
-        for entity in notes.web_entities:
+        def add_entity(lines, entity):
             lines.append('* Score      : {}'.format(entity.score))
             lines.append('* Description: {}'.format(entity.description))
+        add_items(lines, web.entities, add_entity, limit)
 
     return lines
-# [END def_detect_web_uri]
-
 
-def detect_mac_addresses(path):
-    """Detects MAC addresses in the image."""
-    client = vision.ImageAnnotatorClient()
-    mac_addresses = []
+def render_mac_addresses(macs, limit=None):
+    """Renders MAC address results as Spark markdown lines."""
     lines = []
     lines.append('\n**MAC Addresses:**')
+    add_items(lines, macs, lambda lines, mac: lines.append('* ' + mac), limit)
+    return lines
 
-    with io.open(path, 'rb') as image_file:
-        content = image_file.read()
 
-    image = types.Image(content=content)
+# Parser, markdown renderer and summary title of each feature, in the order
+# results are posted
+feature_handlers = (
+    ('web', parse_web, render_web, 'Web'),
+    ('text', parse_text, render_text, 'Text'),
+    ('faces', parse_faces, render_faces, 'Faces'),
+    ('labels', parse_labels, render_labels, 'Labels'),
+    ('landmarks', parse_landmarks, render_landmarks, 'Landmarks'),
+    ('logos', parse_logos, render_logos, 'Logos'),
+    ('macs', parse_mac_addresses, render_mac_addresses, 'MAC addresses'),
+)
+
+# reads the results of features from a Vision response
+def parse_response(response, features=default_features):
+    result = AnalysisResult(error=response.error.message or None)
+    for name, parse, render, title in feature_handlers:
+        if name in features:
+            setattr(result, name, parse(response))
+    return result
+
+# renders the results of an analysis as Spark markdown sections, in posting
+# order, with at most limit items per list when limit is given
+def render_markdown(result, limit=None):
+    return [render(getattr(result, name), limit) for name, parse, render, title in feature_handlers
+            if getattr(result, name) is not None]
+
+# renders the results of an analysis as JSON
+def render_json(result):
+    return json.dumps(result.to_dict())
+
+# sums up each feature of an analysis in a line of text, with its top items
+def summarize(result, top=3):
+    """Returns the summary line of each analysed feature, by feature name.
+
+    Only the top items of each feature are formatted, so a summary stays
+    cheap to build however large the analysis is.
+    """
+    def items(values):
+        line = ', '.join(values[:top])
+        if len(values) > top:
+            line += ' (+{} more)'.format(len(values) - top)
+        return line
+
+    summary = collections.OrderedDict()
+    for name, parse, render, title in feature_handlers:
+        value = getattr(result, name)
+        if not value:
+            continue
+        if name == 'web':
+            line = '{} pages, {} full and {} partial matches'.format(
+                len(value.pages), len(value.full_matches), len(value.partial_matches))
+            if value.entities:
+                line += '; ' + items([entity.description for entity in value.entities])
+        elif name == 'text':
+            line = '"{}"'.format(' '.join(value[0].description.split()[:top * 10]))
+        elif name == 'faces':
+            line = items(['joy: {}'.format(face.joy) for face in value])
+        elif name == 'macs':
+            line = items(value)
+        else:
+            line = items([entity.description for entity in value])
+        summary[name] = line
+    return summary
+
+# renders the summary of an analysis as a Spark markdown section
+def render_summary(result, top=3):
+    titles = dict((name, title) for name, parse, render, title in feature_handlers)
+    return [['\n**Summary:**'] + ['* **{}:** {}'.format(titles[name], line)
+                                    for name, line in summarize(result, top).items()]]
+
+# renders an analysis result into the texts the Bot posts
+def render_post(result):
+    if result_summary_items:
+        return format_sections(render_summary(result, result_summary_items))
+    return format_sections(render_markdown(result))
 
-    response = client.text_detection(image=image)
-    texts = response.text_annotations
-
-    for text in texts:
-        #Match MAC addresses in format aa:bb:cc:dd:ee:ff or aa-bb-cc-dd-ee-ff
-        tmp_text = text.description
-
-        match_regex = re.compile('^' + '[\:\-]'.join(['([0-9A-F]{1,2})']*6) + '$', re.IGNORECASE)
-        matched_mac_addresses = match_regex.findall(tmp_text)
-        if len(matched_mac_addresses) == 0:
-            #Match MAC addresses in format aabbccddeeff
-            match_regex = re.compile('^' + '([0-9A-F]{2})'*6 + '$', re.IGNORECASE)
-            matched_mac_addresses = match_regex.findall(tmp_text)
-            if len(matched_mac_addresses) == 0:
-                #Match MAC addresses in format abcd.abcd.abcd
-                match_regex = re.compile('^' + '([0-9A-F]{4})'*3 + '$', re.IGNORECASE)
-                matched_mac_addresses = match_regex.findall(tmp_text)
-            
-
-        if len(matched_mac_addresses) > 0:
-            #print (str(len(matched_mac_addresses)) + " matches found in text : " + tmp_text )
-            for mac in matched_mac_addresses:
-                lines.append('* ' + ':'.join(mac))
+################################################################################
 
-    return lines
+
+############################## Vision Result Cache #############################
+
+class ResultCache(object):
+    """Keeps formatted analysis results in memory, evicting the least
+    recently used entry beyond max_entries and any entry older than ttl
+    seconds."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # stores value unless key holds a live entry, returns True if stored
+    def add(self, key, value):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] <= self.ttl:
+                return False
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class DiskResultCache(ResultCache):
+    """Keeps formatted analysis results as JSON files in a directory, so they
+    survive restarts. File modification times track recency.
+
+    Evicting lists and stats every file, so it only runs once every tenth
+    of max_entries writes, and the directory may hold up to a tenth more
+    entries in between.
+    """
+
+    def __init__(self, directory, max_entries, ttl):
+        ResultCache.__init__(self, max_entries, ttl)
+        self.directory = directory
+        self.evict_every = max(1, max_entries // 10)
+        self.writes = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, key):
+        path = self.path(key)
+        with self.lock:
+            value = None
+            try:
+                with io.open(path, 'r', encoding='utf-8') as cache_file:
+                    entry = json.load(cache_file)
+                if time.time() - entry['stored'] > self.ttl:
+                    os.remove(path)
+                else:
+                    value = entry['value']
+                    os.utime(path, None)
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key, value):
+        path = self.path(key)
+        # Several worker processes may share the directory
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with self.lock:
+            with io.open(tmp_path, 'w', encoding='utf-8') as cache_file:
+                cache_file.write(json.dumps({'stored': time.time(), 'value': value}))
+            os.rename(tmp_path, path)
+            self.written()
+
+    # stores value unless key holds a live entry, returns True if stored;
+    # atomic across the processes sharing the directory
+    def add(self, key, value):
+        path = self.path(key)
+        with self.lock:
+            for attempt in (1, 2):
+                try:
+                    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+                except OSError:
+                    try:
+                        if time.time() - os.path.getmtime(path) <= self.ttl or attempt == 2:
+                            return False
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+
+                with io.open(fd, 'w', encoding='utf-8') as cache_file:
+                    cache_file.write(json.dumps({'stored': time.time(), 'value': value}))
+                self.written()
+                return True
+            return False
+
+    def delete(self, key):
+        with self.lock:
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def files(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.endswith('.json')]
+
+    def written(self):
+        self.writes += 1
+        if self.writes % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        files = []
+        for path in self.files():
+            try:
+                files.append((os.path.getmtime(path), path))
+            except OSError:
+                # Another process sharing the directory removed it
+                pass
+        files.sort()
+        for mtime, path in files[:max(0, len(files) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.files()), 'hits': self.hits, 'misses': self.misses}
+
+
+# normalizes a URL so trivially different spellings share a cache entry
+def canonical_url(url):
+    parts = urlsplit(url.strip())
+    netloc = parts.netloc.lower()
+    if (parts.scheme, netloc.rsplit(':', 1)[-1]) in (('http', '80'), ('https', '443')):
+        netloc = netloc.rsplit(':', 1)[0]
+    return urlunsplit((parts.scheme.lower(), netloc, parts.path or '/', parts.query, ''))
+
+# Version of the cached analysis results, changed with the AnalysisResult
+# fields so that results cached on disk by older versions are not read. The
+# feature limits the results were read with are part of it.
+result_version = 'v3.' + hashlib.sha1(json.dumps(feature_limits, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+
+# prefixes cache keys with the requested features, results depend on them
+def cache_key(source, features):
+    return result_version + ':' + ','.join(
+        feature for feature in all_features if feature in features) + '|' + source
+
+# builds the cache key of a Vision image from its content or its URL
+def image_cache_key(image, features=default_features):
+    if image.content:
+        return cache_key('sha256:' + hashlib.sha256(image.content).hexdigest(), features)
+    return url_cache_key(image.source.image_uri, features)
+
+# builds the cache key of the image an URL points to
+def url_cache_key(url, features=default_features):
+    return cache_key('url:' + canonical_url(url), features)
+
+# returns the AnalysisResult cached under key, None if there is none
+def cached_result(key):
+    data = results.get(key)
+    if data is None:
+        return None
+    return AnalysisResult.from_dict(data)
+
+# analyses an image unless the same image has already been analysed
+def analyze_image_cached(image, features=default_features):
+    key = image_cache_key(image, features)
+    result = cached_result(key)
+    if result is None:
+        result = analyze_image(image, features)
+        # Vision errors are not cached, the next request tries again
+        if not result.error:
+            results.set(key, result.to_dict())
+    else:
+        logging.info("Serving cached analysis for %s", key)
+    return result
+
+
+class ImageHashIndex(object):
+    """Finds the analysed images whose perceptual hash is within
+    max_distance bits of a new one, among the max_entries most recently
+    added.
+
+    Hashes are split into max_distance + 1 bands. Two hashes that differ in
+    at most max_distance bits share at least one identical band, so only
+    the hashes sharing a band with the one looked up are compared. The
+    index is saved to a JSON file when path is set, at most every
+    save_interval seconds.
+    """
+
+    def __init__(self, max_entries, max_distance, path=None, save_interval=60):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.path = path
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        bands = min(64, max_distance + 1)
+        self.bounds = [64 * i // bands for i in range(bands + 1)]
+        self.entries = collections.OrderedDict()
+        self.buckets = collections.defaultdict(set)
+        self.saved = time.time()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def bands(self, features, image_hash):
+        for band, (low, high) in enumerate(zip(self.bounds, self.bounds[1:])):
+            yield features, band, (image_hash >> low) & ((1 << (high - low)) - 1)
+
+    # returns the result cache key of the closest image analysed for the
+    # same features, None if there is none close enough
+    def find(self, image_hash, features):
+        features = cache_key('', features)
+        with self.lock:
+            best = None
+            for bucket in self.bands(features, image_hash):
+                for candidate in self.buckets.get(bucket, ()):
+                    distance = bin(candidate ^ image_hash).count('1')
+                    if distance <= self.max_distance and (best is None or distance < best[0]):
+                        best = (distance, candidate)
+
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end((features, best[1]))
+            return self.entries[(features, best[1])]
+
+    def add(self, image_hash, features, key):
+        with self.lock:
+            self.insert(cache_key('', features), image_hash, key)
+            self.dirty = True
+            if self.path and time.time() - self.saved >= self.save_interval:
+                self.save()
+
+    def insert(self, features, image_hash, key):
+        if (features, image_hash) not in self.entries:
+            for bucket in self.bands(features, image_hash):
+                self.buckets[bucket].add(image_hash)
+        self.entries[(features, image_hash)] = key
+        self.entries.move_to_end((features, image_hash))
+
+        while len(self.entries) > self.max_entries:
+            (old_features, old_hash), _ = self.entries.popitem(last=False)
+            for bucket in self.bands(old_features, old_hash):
+                self.buckets[bucket].discard(old_hash)
+                if not self.buckets[bucket]:
+                    del self.buckets[bucket]
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with io.open(self.path, 'r', encoding='utf-8') as index_file:
+                for features, image_hash, key in json.load(index_file):
+                    self.insert(features, image_hash, key)
+        except (IOError, ValueError):
+            logging.exception("Could not load image hashes from %s", self.path)
+
+    def save(self):
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with io.open(tmp_path, 'w', encoding='utf-8') as index_file:
+            index_file.write(json.dumps([[features, image_hash, key]
+                for (features, image_hash), key in self.entries.items()]))
+        os.rename(tmp_path, self.path)
+        self.saved = time.time()
+        self.dirty = False
+
+    # saves the hashes added since the last save
+    def flush(self):
+        with self.lock:
+            if self.path and self.dirty:
+                self.save()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+# analyses an encoded image unless the same image has already been
+# analysed, reusing the results of a visually identical image for the
+# features that survive rescaling
+def analyze_image_similar(content, image_hash, features=default_features):
+    """Returns the AnalysisResult of an image for the given features.
+
+    When an image within image_hash_distance bits was analysed before, its
+    web, labels, landmarks and logos results are reused, and Google Vision
+    is only asked for the other features, e.g. text, which may differ
+    between photos of labels that hash alike.
+    """
+    image = types.Image(content=content)
+    similar = tuple(feature for feature in features if feature in similar_features)
+    if image_hashes is None or image_hash is None or not similar:
+        return analyze_image_cached(image, features)
+
+    key = image_cache_key(image, features)
+    result = cached_result(key)
+    if result is not None:
+        logging.info("Serving cached analysis for %s", key)
+        return result
+
+    match = image_hashes.find(image_hash, similar)
+    matched = cached_result(match) if match is not None else None
+    if matched is not None:
+        metrics.inc('near_duplicates_total')
+        logging.info("Serving %s of a similar image for %s", ', '.join(similar), match)
+        others = tuple(feature for feature in features if feature not in similar)
+        result = analyze_image_cached(image, others) if others else AnalysisResult()
+        for feature in similar:
+            setattr(result, feature, getattr(matched, feature))
+        return result
+
+    result = analyze_image(image, features)
+    if not result.error:
+        results.set(key, result.to_dict())
+        image_hashes.add(image_hash, similar, key)
+    return result
 
 ################################################################################
 
 
+################################ Feature Profiles ##############################
+
+# Words selecting a feature in a message, e.g. "@GoogleVision text macs"
+feature_words = {
+    'web': 'web',
+    'text': 'text', 'texts': 'text', 'ocr': 'text',
+    'face': 'faces', 'faces': 'faces',
+    'label': 'labels', 'labels': 'labels',
+    'landmark': 'landmarks', 'landmarks': 'landmarks',
+    'logo': 'logos', 'logos': 'logos',
+    'mac': 'macs', 'macs': 'macs',
+    'all': all_features,
+}
+
+url_regex = re.compile('http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+
+# returns the words of a message that may hold a command: those following
+# the mention of the bot, or else all of them
+def command_words(text):
+    words = re.findall('[a-z]+', url_regex.sub(' ', text.lower()))
+    name = re.findall('[a-z]+', bot_name.lower())
+    for i in range(len(words) - len(name) + 1):
+        if name and words[i:i + len(name)] == name:
+            return words[i + len(name):]
+    return words
+
+# finds the features named at the start of a command, None if there are
+# none; words of ordinary sentences, e.g. "read the text", are not commands
+def parse_features(text):
+    features = set()
+    for word in command_words(text):
+        feature = feature_words.get(word)
+        if feature is None:
+            break
+        if isinstance(feature, tuple):
+            features.update(feature)
+        elif feature:
+            features.add(feature)
+
+    if not features:
+        return None
+    return tuple(feature for feature in all_features if feature in features)
+
+
+class FeatureProfiles(object):
+    """Keeps the features analysed in each room. Profiles are cached in
+    memory and saved to a JSON file when path is set."""
+
+    def __init__(self, path, defaults):
+        self.path = path
+        self.defaults = tuple(defaults)
+        self.lock = threading.Lock()
+        self.profiles = None
+        self.mtime = None
+
+    # (re)loads the profiles when the file was changed, e.g. by another worker
+    def load(self):
+        mtime = None
+        if self.path and os.path.exists(self.path):
+            mtime = os.path.getmtime(self.path)
+        if self.profiles is not None and mtime == self.mtime:
+            return
+
+        self.profiles = {}
+        self.mtime = mtime
+        if mtime is not None:
+            try:
+                with io.open(self.path, 'r', encoding='utf-8') as profiles_file:
+                    self.profiles = json.load(profiles_file)
+            except (IOError, ValueError):
+                logging.exception("Could not load room profiles from %s", self.path)
+
+    def save(self):
+        if self.path:
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with io.open(tmp_path, 'w', encoding='utf-8') as profiles_file:
+                profiles_file.write(json.dumps(self.profiles))
+            os.rename(tmp_path, self.path)
+            self.mtime = os.path.getmtime(self.path)
+
+    def get(self, roomId):
+        with self.lock:
+            self.load()
+            return tuple(self.profiles.get(roomId, self.defaults))
+
+    def set(self, roomId, features):
+        with self.lock:
+            self.load()
+            self.profiles[roomId] = list(features)
+            self.save()
+
+    def reset(self, roomId):
+        with self.lock:
+            self.load()
+            self.profiles.pop(roomId, None)
+            self.save()
+
+profiles = FeatureProfiles(room_profiles_path, default_features)
+
+# picks the features to analyse for a message: the ones named in its text,
+# else those of the room profile
+def request_features(roomId, text):
+    return parse_features(text or '') or profiles.get(roomId)
+
+# handles "profile" commands setting the features analysed in a room,
+# returns the reply to post or None if text is not a profile command
+def profile_command(roomId, text):
+    words = command_words(text)
+    if words[:1] != ['profile']:
+        return None
+
+    arguments = words[1:]
+    if arguments[:1] in (['default'], ['reset']):
+        profiles.reset(roomId)
+    else:
+        features = parse_features(' '.join(arguments))
+        if features:
+            profiles.set(roomId, features)
+
+    return "Features analysed in this room: **" + ', '.join(profiles.get(roomId)) + "**"
 
+################################################################################
 
-# Flask used as listener for webhooks from Spark
-app = Flask(__name__)
 
-@app.route('/',methods=['POST'])
-def listener():
-    # On receipt of a POST (webhook), load the JSON data from the request
-    data = json.loads(request.data.decode('utf-8'))
-    headers = request.headers
-    #print data
+############################### Webhook Job Queue ##############################
 
-    messageID = data['data']['id']
-    roomID = data['data']['roomId']
+# logs the times of a job, and the peak memory of the process once it is done
+# along with how much the job raised it (other jobs running at the same time
+# count too)
+def log_job(job_id, wait, processing, rss_before, rss):
+    if rss is None:
+        logging.info("Job %s waited %.3fs, processed in %.3fs", job_id, wait, processing)
+    else:
+        logging.info("Job %s waited %.3fs, processed in %.3fs, peak RSS %.1f MB (+%.1f MB)",
+            job_id, wait, processing, rss / 1048576.0, (rss - rss_before) / 1048576.0)
 
-    #print ("Data from webhook:")
-    #print (json.dumps(data, indent=4))
 
-    #print ("\nHeaders from webhook:")
-    #print (headers)
+class JobQueue(object):
+    """Runs webhook jobs on a bounded pool of worker threads.
 
-    # If the poster of the message was NOT the bot itself
-    if data['actorId'] != bot_id:
-        spark_headers = set_headers(bot_token)
+    Jobs are rejected instead of queued once max_depth jobs are waiting, so
+    the webhook can push back on Spark rather than pile up work.
+    """
 
-        # Get more specific information about the message that triggered the webhook
-        json_string = get_message_details(spark_headers, messageID)
-        message = json.loads(json_string)
+    def __init__(self, workers, max_depth):
+        self.workers = workers
+        self.queue = queue.Queue(max_depth)
+        self.lock = threading.Lock()
+        self.pid = None
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_processing = 0.0
+        self.max_processing = 0.0
+        self.max_rss_growth = 0
+
+    def start(self):
+        # Worker threads do not survive a fork, start them in each process
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            for i in range(self.workers):
+                worker = threading.Thread(target=self.work, name='job-worker-{}'.format(i))
+                worker.daemon = True
+                worker.start()
+
+    def submit(self, job_id, func, *args):
+        self.start()
+        try:
+            self.queue.put_nowait((job_id, time.time(), func, args))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            logging.warning("Job queue full, rejecting job %s", job_id)
+            return False
+
+        with self.lock:
+            self.submitted += 1
+        return True
+
+    def work(self):
+        while True:
+            job_id, enqueued, func, args = self.queue.get()
+            started = time.time()
+            wait = started - enqueued
+            rss_before = peak_rss()
+            failed = False
+            try:
+                func(*args)
+            except Exception:
+                failed = True
+                logging.exception("Job %s failed", job_id)
+            processing = time.time() - started
+            rss = peak_rss()
+
+            with self.lock:
+                if failed:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.total_processing += processing
+                self.max_processing = max(self.max_processing, processing)
+                if rss is not None:
+                    self.max_rss_growth = max(self.max_rss_growth, rss - rss_before)
+
+            metrics.observe('stage_seconds', wait, stage='queue_wait')
+            metrics.observe('stage_seconds', processing, stage='job')
+            metrics.inc('jobs_total', status='failed' if failed else 'completed')
+            log_job(job_id, wait, processing, rss_before, rss)
+            self.queue.task_done()
+
+    def stats(self):
+        with self.lock:
+            done = self.completed + self.failed
+            return {
+                'depth': self.queue.qsize(),
+                'workers': self.workers,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'avg_wait': self.total_wait / done if done else 0.0,
+                'max_wait': self.max_wait,
+                'avg_processing': self.total_processing / done if done else 0.0,
+                'max_processing': self.max_processing,
+                'max_rss_growth': self.max_rss_growth,
+            }
+
+
+class SeenMessages(object):
+    """Remembers the IDs of recently handled webhook messages in a cache,
+    so that duplicate deliveries can be skipped."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.skipped = 0
+
+    # records message_id, returns True if it had already been recorded
+    def seen(self, message_id):
+        if self.cache.add(message_id, time.time()):
+            return False
+        with self.lock:
+            self.skipped += 1
+        return True
+
+    def forget(self, message_id):
+        self.cache.delete(message_id)
+
+    def stats(self):
+        stats = self.cache.stats()
+        return {'entries': stats['entries'], 'skipped': self.skipped}
 
-        #print ("\n\nMessage details: ")
-        #print (json.dumps(message, indent=4))
+################################################################################
 
-        if 'files' in data['data']:
-            for item in data['data']['files']:
-                response = requests.request("GET", item, headers=spark_headers)
-                if response.status_code == 200:
-                    imgHeaders = response.headers
-                    if 'image' in imgHeaders['Content-Type']:
-                        filename = imgHeaders[
-                            'Content-Disposition'].replace("attachment; ", "").replace('filename', '').replace('=', '').replace('"', '')
 
-                        with open(filename, 'wb') as f:
-                            f.write(response.content)
+################################# Worker State #################################
 
-                        filename = resize_image(filename, base_img_width)
+# creates the clients, caches, pools and queues of a worker process
+def init_worker():
+    """Creates the state shared by the threads of a worker process.
 
-                        #Analyse image with Google Vision API
-                        lines = detect_web(filename)
-                        if len(lines) > 1:
-                            myStr = '\n'.join(lines)
-                            post_message_to_room(spark_headers,roomID,myStr)
+    Runs on import and again in every worker forked by a production server
+    (see gunicorn.conf.py), so that no connection pool, thread pool or lock
+    is inherited from the parent process.
+    """
+    global metrics, web, spark, results, seen_messages, message_details
+    global jobs, message_items, vision_fanout, vision_limiter, spark_limiter
+    global image_hashes, image_memory
+
+    metrics = Metrics('spark_bot')
+
+    # Decoded images of all the jobs of the process share one budget
+    image_memory = MemoryBudget(image_memory_budget)
+
+    # Quotas apply to each worker process
+    vision_limiter = RateLimiter('vision', vision_rate, vision_burst,
+        vision_max_concurrency, rate_limit_max_wait)
+    spark_limiter = RateLimiter('spark', spark_rate, spark_burst,
+        spark_max_concurrency, rate_limit_max_wait)
+
+    # Session without the bot credentials, for images posted as URLs
+    web = requests.Session()
+    spark = SparkClient(bot_token, spark_api_url, spark_timeout, spark_retries,
+        spark_pool_size, spark_limiter)
+
+    if result_cache_dir:
+        results = DiskResultCache(result_cache_dir, result_cache_size, result_cache_ttl)
+    else:
+        results = ResultCache(result_cache_size, result_cache_ttl)
+
+    if seen_messages_dir:
+        seen_messages = SeenMessages(DiskResultCache(seen_messages_dir, seen_messages_size, seen_messages_ttl))
+    else:
+        seen_messages = SeenMessages(ResultCache(seen_messages_size, seen_messages_ttl))
+
+    # Message details are kept briefly in case the same message is handled again
+    message_details = ResultCache(1000, message_details_ttl)
+
+    if image_hash_distance is None:
+        image_hashes = None
+    else:
+        image_hashes = ImageHashIndex(image_hash_size, image_hash_distance, image_hash_path)
+        atexit.register(image_hashes.flush)
+
+    jobs = JobQueue(worker_threads, job_queue_size)
+
+    # Every job worker runs at most message_item_concurrency items and one
+    # message detail fetch at once, so the pool can never be exhausted
+    message_items = futures.ThreadPoolExecutor(max_workers=worker_threads * (message_item_concurrency + 1))
+    # Likewise every item in flight can fan out one Vision call per feature,
+    # so that no call has to queue and use up its deadline waiting
+    vision_fanout = futures.ThreadPoolExecutor(max_workers=vision_fanout_workers
+        or worker_threads * message_item_concurrency * len(vision_features))
+
+    # A Vision client inherited from the parent would share its gRPC channel
+    vision_clients.reset()
+
+    for name, collect in (('job_queue', lambda: jobs.stats()),
+                          ('vision_clients', lambda: vision_clients.stats()),
+                          ('result_cache', lambda: results.stats()),
+                          ('seen_messages', lambda: seen_messages.stats()),
+                          ('image_hashes', lambda: image_hashes.stats() if image_hashes else {}),
+                          ('vision_limiter', lambda: vision_limiter.stats()),
+                          ('spark_limiter', lambda: spark_limiter.stats()),
+                          ('image_memory', lambda: image_memory.stats()),
+                          ('process', lambda: {'peak_rss_bytes': peak_rss()})):
+        metrics.register(lambda name=name, collect=collect: [
+            (name + '_' + stat, {}, value) for stat, value in sorted(collect().items())])
+
+# gets the public ngrok tunnel and points the Spark webhook to it, once per
+# deployment rather than once per worker
+def register_webhook():
+    logging.info("Updating webhook with ngrok tunnel details")
+    ngrok_tunnels = get_ngrok_tunnels(ngrok_url)
+    # Use the tunnel of ngrok_proto, or else whichever ngrok has
+    public_url = ngrok_tunnels.get('public_{}_url'.format(ngrok_proto))
+    if public_url is None and ngrok_tunnels:
+        public_url = sorted(ngrok_tunnels.items())[0][1]
+    if public_url is None:
+        raise RuntimeError("No ngrok tunnel found at " + ngrok_url)
+    status_code = spark.update_webhook(webhook_name, webhook_id, public_url)
+    logging.info("Webhook update status code: %s", status_code)
+    if status_code != 200:
+        raise RuntimeError("Updating the webhook failed with status {}".format(status_code))
+
+# registers the webhook from a background thread, retrying with a growing
+# delay until ngrok and Spark answer, so that serving does not wait for them
+def register_webhook_in_background():
+    def register():
+        for attempt in range(webhook_retries + 1):
+            try:
+                with startup_stage('register_webhook'):
+                    register_webhook()
+                return
+            except Exception:
+                delay = min(60, webhook_backoff * (2 ** attempt))
+                logging.warning("Could not update the Spark webhook, attempt %d of %d",
+                    attempt + 1, webhook_retries + 1, exc_info=True)
+                if attempt < webhook_retries:
+                    time.sleep(delay)
+        logging.error("Giving up updating the Spark webhook")
+
+    thread = threading.Thread(target=register, name='register-webhook')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+# creates the Google Vision client in the background, before the first
+# webhook needs it
+def warm_up_in_background():
+    def warm_up():
+        try:
+            with startup_stage('vision_client'):
+                vision_clients.get()
+        except Exception:
+            logging.exception("Could not create the Google Vision client")
+
+    thread = threading.Thread(target=warm_up, name='warm-up')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+startup_timings['imports'] = time.time() - import_started
+with startup_stage('init_worker'):
+    init_worker()
 
-                        lines = detect_text(filename)
-                        if len(lines) > 1:
-                            myStr = '\n'.join(lines)
-                            post_message_to_room(spark_headers,roomID,myStr)
+################################################################################
 
-                        lines = detect_faces(filename)
-                        if len(lines) > 1:
-                            myStr = '\n'.join(lines)
-                            post_message_to_room(spark_headers,roomID,myStr)
 
-                        lines = detect_labels(filename)
-                        if len(lines) > 1:
-                            myStr = '\n'.join(lines)
-                            post_message_to_room(spark_headers,roomID,myStr)
+# Flask route receiving the webhooks from Spark
+def listener():
+    # On receipt of a POST (webhook), load the JSON data from the request
+    try:
+        data = json.loads(request.get_data().decode('utf-8'))
+        messageID = data['data']['id']
+        # The room is used later on, check that there is one
+        data['data']['roomId']
+        actorID = data['actorId']
+    except (ValueError, KeyError, TypeError):
+        return "Invalid webhook payload", 400
+
+    # If the poster of the message was the bot itself, there is nothing to do
+    if actorID == bot_id:
+        metrics.inc('webhooks_skipped_total', reason='bot')
+        return "OK"
+
+    # Spark retries and duplicate deliveries are only analysed once
+    if seen_messages.seen(messageID):
+        metrics.inc('webhooks_skipped_total', reason='duplicate')
+        logging.info("Skipping duplicate delivery of message %s", messageID)
+        return "OK"
+
+    # Analyse in the background so Spark gets its answer before it times out
+    if not jobs.submit(messageID, process_webhook, data):
+        # Let the retry of a rejected webhook through
+        seen_messages.forget(messageID)
+        return "Busy", 503
 
-                        lines = detect_landmarks(filename)
-                        if len(lines) > 1:
-                            myStr = '\n'.join(lines)
-                            post_message_to_room(spark_headers,roomID,myStr)
+    return "OK"
 
-                        lines = detect_logos(filename)
-                        if len(lines) > 1:
-                            myStr = '\n'.join(lines)
-                            post_message_to_room(spark_headers,roomID,myStr)
+# job statistics, given by the pipeline, with those of the shared state
+def stats_report(job_stats):
+    return {
+        'jobs': job_stats,
+        'vision_clients': vision_clients.stats(),
+        'results': results.stats(),
+        'seen_messages': seen_messages.stats(),
+        'image_hashes': image_hashes.stats() if image_hashes else None,
+        'rate_limits': {'vision': vision_limiter.stats(), 'spark': spark_limiter.stats()},
+        'image_memory': image_memory.stats(),
+        'peak_rss': peak_rss(),
+        'startup': startup_timings,
+    }
 
-                        if detect_macs:
-                            lines = detect_mac_addresses(filename)
-                            if len(lines) > 1:
-                                myStr = '\n'.join(lines)
-                                post_message_to_room(spark_headers,roomID,myStr)
+# reports job queue and Google Vision client statistics
+def stats():
+    return json.dumps(stats_report(jobs.stats()))
+
+# exposes stage latencies, error counts and statistics to Prometheus
+def prometheus_metrics():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+# runs func over items with at most limit calls in flight, yielding
+# (item, result, error) tuples in the order of items as soon as possible
+def map_in_order(func, items, limit):
+    items = list(items)
+    message_id = trace.message_id
+
+    def traced(item):
+        trace.message_id = message_id
+        return func(item)
+    running = {}
+    done = {}
+    submitted = 0
+
+    for index in range(len(items)):
+        while index not in done:
+            while submitted < len(items) and len(running) < limit:
+                running[message_items.submit(traced, items[submitted])] = submitted
+                submitted += 1
+
+            finished, _ = futures.wait(list(running), return_when=futures.FIRST_COMPLETED)
+            for future in finished:
+                done[running.pop(future)] = future
+
+        future = done.pop(index)
+        error = future.exception()
+        yield items[index], None if error else future.result(), error
+
+# downloads and analyses a file posted to the room, returns the texts to post
+def analyze_file(item, get_features):
+    response = spark.download(item)
+    if response.status_code != 200:
+        response.close()
+        return []
+
+    content = None
+    if is_image_type(response.headers):
+        # The file is streamed, and given up once larger than file_max_bytes
+        with timed('download_body', 'spark'):
+            content = read_image(response, file_max_bytes)
+    response.close()
+
+    if content is None:
+        #print(item + " is not an image")
+        return ["Ahoy! Thanks for sending me your \
+            file. However, I only analyze images."]
+
+    hashes = {}
+    with timed('resize'):
+        content = resize_image(content, base_img_width, hashes=hashes)
+
+    #Analyse image with Google Vision API
+    features = get_features()
+    return render_post(analyze_image_similar(content, hashes.get('dhash'), features)) + [project_info]
+
+# analyses the image an URL points to, returns the texts to post
+def analyze_url(url, get_features):
+    features = get_features()
+    key = url_cache_key(url, features)
+    result = cached_result(key)
+
+    if result is None:
+        with timed('url_fetch', 'web'):
+            content = fetch_image(url)
+
+        #Only send the image to Google Vision API if url is an image
+        if content is None:
+            #print(url + " is not an image")
+            return ["Ahoy! Thanks for sending me your \
+                url. However, I only analyze images."]
+
+        hashes = {}
+        with timed('resize'):
+            content = resize_image(content, base_img_width, hashes=hashes)
+
+        result = analyze_image_similar(content, hashes.get('dhash'), features)
+        if not result.error:
+            results.set(key, result.to_dict())
+
+    return render_post(result) + [project_info]
+
+# get more specific information about the message that triggered the webhook
+def get_message_details(messageID):
+    message = message_details.get(messageID)
+    if message is None:
+        message = json.loads(spark.get_message_details(messageID))
+        message_details.set(messageID, message)
+    return message
+
+# features to analyse the files of a message with, once the details future
+# fetching the message is done: those its text names, or else the room
+# profile so that the files are still analysed
+def file_features(messageID, roomID, details):
+    error = details.exception()
+    if error is not None:
+        logging.warning("Fetching message %s failed, using the room profile", messageID, exc_info=error)
+        return profiles.get(roomID)
+    return request_features(roomID, details.result().get('text'))
+
+# reads a message without files, returns the image URLs it asks to analyse
+# and the reply to a profile command or to a help request, if any
+def read_message(roomID, text):
+    reply = profile_command(roomID, text)
+    if reply is not None:
+        return [], reply
+    urls = url_regex.findall(text)
+    if len(urls) == 0 and (('help' in str.lower(text)) or (text == '?')):
+        return urls, help_msg
+    return urls, None
+
+# analyses the image files or image URLs of a webhook and posts the results
+def process_webhook(data):
+    messageID = data['data']['id']
+    roomID = data['data']['roomId']
+    trace.message_id = messageID
 
+    #print ("Data from webhook:")
+    #print (json.dumps(data, indent=4))
 
-                        #Delete file
-                        os.remove(filename)
+    # Results are packed into as few messages as possible
+    composer = MessageComposer(spark, roomID, spark_max_message_bytes, spark_streaming_messages)
 
-                        post_message_to_room(spark_headers,roomID,project_info)
+    if 'files' in data['data']:
+        items = data['data']['files']
+        analyze_item = analyze_file
 
-                    else:
-                        #print(filename + " is not an image")
-                        post_message_to_room(spark_headers,roomID,"Ahoy! Thanks for sending me your \
-                            file. However, I only analyze images.")
+        # The text may name the features to analyse, fetch it while the
+        # files download
+        details = message_items.submit(get_message_details, messageID)
 
-        else:
-            #print ("No files posted...")
-            #let's see if there is an image URL in posted text
-            #print ("Text posted: ", message['text'])
-            urls = re.findall('http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', message['text'])
-            #print ("Urls found", urls)
-
-            if len(urls) > 0:
-                for url in urls:
-                    #check if URL is an image
-                    response = requests.head(url)
-                    #print (response.headers.get('content-type'))
-
-                    #Only send URL to Google Vision API if url is an image
-                    if 'image' in response.headers.get('content-type'):
-                        lines = detect_web_uri(url)
-                        if len(lines) > 1:
-                            myStr = '\n'.join(lines)
-                            post_message_to_room(spark_headers,roomID,myStr)
-
-                        lines = detect_text_uri(url)
-                        if len(lines) > 1:
-                            myStr = '\n'.join(lines)
-                            post_message_to_room(spark_headers,roomID,myStr)
-
-                        lines = detect_faces_uri(url)
-                        if len(lines) > 1:
-                            myStr = '\n'.join(lines)
-                            post_message_to_room(spark_headers,roomID,myStr)
-
-                        lines = detect_labels_uri(url)
-                        if len(lines) > 1:
-                            myStr = '\n'.join(lines)
-                            post_message_to_room(spark_headers,roomID,myStr)
-
-                        lines = detect_landmarks_uri(url)
-                        if len(lines) > 1:
-                            myStr = '\n'.join(lines)
-                            post_message_to_room(spark_headers,roomID,myStr)
-
-                        lines = detect_logos_uri(url)
-                        if len(lines) > 1:
-                            myStr = '\n'.join(lines)
-                            post_message_to_room(spark_headers,roomID,myStr)
-
-                        if detect_macs:
-                            #Download the image and find MAC addresses
-                            response = requests.request("GET", url)
-                            filename = url.split("/")[-1]
-                            with open(filename, 'wb') as f:
-                                f.write(response.content)
-
-                            filename = resize_image(filename, base_img_width)
-
-                            lines = detect_mac_addresses(filename)
-                            if len(lines) > 1:
-                                myStr = '\n'.join(lines)
-                                post_message_to_room(spark_headers,roomID,myStr)
-
-                            #Delete file
-                            os.remove(filename)
-
-                        post_message_to_room(spark_headers,roomID,project_info)
-                    else:
-                        #print(url + " is not an image")
-                        post_message_to_room(spark_headers,roomID,"Ahoy! Thanks for sending me your \
-                            url. However, I only analyze images.")
-
-            elif ('help' in str.lower(message['text'])) or (message['text'] == '?'):
-                post_message_to_room(spark_headers,roomID,help_msg)
+        get_features = lambda: file_features(messageID, roomID, details)
 
-    return "OK"
+    else:
+        # Only the message text is missing from the webhook, fetch it
+        message = get_message_details(messageID)
+        text = message.get('text', '')
 
+        #print ("\n\nMessage details: ")
+        #print (json.dumps(message, indent=4))
 
-# Runs the listener
+        #print ("No files posted...")
+        #let's see if there is an image URL in posted text
+        #print ("Text posted: ", text)
+        items, reply = read_message(roomID, text)
+        analyze_item = analyze_url
+        get_features = lambda: request_features(roomID, text)
+        #print ("Urls found", items)
+
+        if reply is not None:
+            composer.add(reply)
+
+    # Items are analysed concurrently but reported in the order they were posted
+    for item, texts, error in map_in_order(lambda item: analyze_item(item, get_features), items, message_item_concurrency):
+        if isinstance(error, ImageTooLarge):
+            logging.info("Not analysing %s, %s", item, error)
+            composer.add(too_large_msg)
+            continue
+        if error is not None:
+            logging.error("Analysing %s failed", item, exc_info=error)
+            composer.add("Sorry, I could not analyze " + item + ".")
+            continue
+        for text in texts:
+            composer.add(text)
+
+    composer.close()
+
+
+# builds the Flask application listening for webhooks from Spark
+def create_app():
+    app = Flask(__name__)
+    app.add_url_rule('/', 'listener', listener, methods=['POST'])
+    app.add_url_rule('/stats', 'stats', stats, methods=['GET'])
+    app.add_url_rule('/metrics', 'metrics', prometheus_metrics, methods=['GET'])
+    return app
+
+app = create_app()
+
+
+# Runs the listener with the Flask development server, see gunicorn.conf.py
+# for running it in production
 if __name__ == '__main__':
-    #get ngrok tunnel details and update webhook
-    print ("Updating webhook with ngrok tunnel details")
-    headers = set_headers(bot_token)
-    ngrok_tunnels = get_ngrok_tunnels(ngrok_url)
-    public_url = ngrok_tunnels['public_http_url'] # to use https, use the 'public_https_url' key instead
-    print ("Webhook update status code: ", update_webhook(headers, webhook_name, webhook_id, public_url))
+    configure_logging()
+
+    #get ngrok tunnel details and update webhook, only in the parent process
+    #when the debug reloader runs the application in a child process
+    if os.environ.get('WERKZEUG_RUN_MAIN') != 'true':
+        register_webhook_in_background()
+
+    #warm up the Google Vision client before the first webhook arrives
+    warm_up_in_background()
+    report_startup()
 
     #launching main application
     print ("Launching spark bot application")
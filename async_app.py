@@ -0,0 +1,505 @@
+#
+#       asyncio variant of the Spark Bot webhook listener
+#
+#   REQUIREMENTS:
+#       aiohttp python module
+#       everything app.py requires
+#
+#   USAGE:
+#       pip install aiohttp
+#       python async_app.py
+#
+#       Webhooks are handled like by app.py, but Spark calls, image
+#       downloads and URL fetches go through aiohttp on a single event loop
+#       instead of tying up a thread each. Google Vision calls, resizing and
+#       disk caches are blocking, they run on a thread pool of
+#       async_executor_threads threads. One process can keep hundreds of
+#       analyses in flight.
+#
+
+
+import asyncio
+import collections
+import contextvars
+import functools
+import json
+import logging
+import time
+from concurrent import futures
+
+import aiohttp
+from aiohttp import web
+
+import app
+
+# Optional tuning settings, see settings_template.py
+async_max_jobs = getattr(app.settings, 'async_max_jobs', 200)
+async_queue_size = getattr(app.settings, 'async_queue_size', 1000)
+async_executor_threads = getattr(app.settings, 'async_executor_threads', 32)
+async_connections = getattr(app.settings, 'async_connections', 100)
+
+
+# Answer of an AsyncSparkClient request, with the body already read
+SparkResponse = collections.namedtuple('SparkResponse', 'status headers body')
+
+
+class AsyncSparkClient(object):
+    """Calls the Spark REST API over an aiohttp session, retrying like
+    app.SparkClient. Calls wait for their turn with the RateLimiter given
+    as limiter in the event loop, without holding an executor thread."""
+
+    retry_statuses = app.SparkClient.retry_statuses
+    post_retry_statuses = app.SparkClient.post_retry_statuses
+
+    def __init__(self, session, base_url, retries, limiter=None):
+        self.session = session
+        self.base_url = base_url.rstrip('/')
+        self.retries = retries
+        self.limiter = limiter
+
+    def retry_delay(self, response, attempt):
+        if response is not None:
+            try:
+                return min(float(response.headers['Retry-After']), app.rate_limit_max_wait)
+            except (KeyError, ValueError):
+                pass
+        return app.spark_backoff * (2 ** attempt)
+
+    async def request(self, method, url, stage='spark_request', read=None, **kwargs):
+        if not url.startswith('http'):
+            url = self.base_url + url
+
+        # A POST timing out or losing its connection may still have posted
+        # its message, retrying it would post it twice
+        if method == 'POST':
+            retry_errors = (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError)
+            retry_statuses = self.post_retry_statuses
+        else:
+            retry_errors = (aiohttp.ClientError, asyncio.TimeoutError)
+            retry_statuses = self.retry_statuses
+
+        attempt = 0
+        while True:
+            response = None
+            acquired = False
+            try:
+                if self.limiter:
+                    await acquire(self.limiter)
+                    acquired = True
+                with app.timed(stage, 'spark'):
+                    async with self.session.request(method, url, **kwargs) as resp:
+                        # read streams the body of successful responses
+                        if read is not None and resp.status == 200:
+                            body = await read(resp)
+                        else:
+                            body = await resp.read()
+                        response = SparkResponse(resp.status, resp.headers, body)
+            except retry_errors:
+                if attempt >= self.retries:
+                    raise
+            else:
+                if response.status >= 400:
+                    app.metrics.inc('dependency_errors_total', dependency='spark')
+                if response.status not in retry_statuses or attempt >= self.retries:
+                    return response
+            finally:
+                if acquired:
+                    self.limiter.release(response is not None and response.status == 429)
+
+            delay = self.retry_delay(response, attempt)
+            logging.warning("Spark %s %s failed, retrying in %.1fs", method, url, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    # posts a message to the room
+    async def post_message(self, roomId, msg):
+        message = {"roomId":roomId,"markdown":msg}
+        resp = await self.request("POST", "/messages", 'spark_post_message', json=message)
+        if resp.status != 200:
+            logging.warning("Posting message to room failed: %s %s", resp.status, resp.body)
+        return resp
+
+    # edits a message posted to the room
+    async def edit_message(self, msgId, roomId, msg):
+        message = {"roomId":roomId,"markdown":msg}
+        resp = await self.request("PUT", "/messages/" + msgId, 'spark_edit_message', json=message)
+        if resp.status != 200:
+            logging.warning("Editing message failed: %s %s", resp.status, resp.body)
+        return resp
+
+    # get message details
+    async def get_message_details(self, msgId):
+        resp = await self.request("GET", "/messages/" + msgId, 'spark_message_details')
+        return resp.body.decode('utf-8')
+
+    # downloads a file posted to a room, its body is None if it is not an
+    # image; large files take longer than spark_timeout, which only bounds
+    # each read
+    async def download(self, url):
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=app.spark_timeout,
+            sock_read=app.spark_timeout)
+        return await self.request("GET", url, 'download', timeout=timeout, read=read_file)
+
+
+class PackedMessage(object):
+    """A message of a MessagePacker, with its Spark ID once posted."""
+
+    __slots__ = ('id',)
+
+    def __init__(self):
+        self.id = None
+
+
+class MessagePacker(app.MessageComposer):
+    """Packs texts into messages like app.MessageComposer, but keeps them
+    for the caller to post asynchronously. In streaming mode the caller
+    posts each message once it has a section and edits it as others are
+    appended, see post_messages()."""
+
+    def __init__(self, max_bytes, streaming=False):
+        app.MessageComposer.__init__(self, None, None, max_bytes, streaming)
+        self.ready = collections.OrderedDict()
+
+    def publish(self):
+        # message_id stands for the message until it is posted
+        if self.message_id is None:
+            self.message_id = PackedMessage()
+        self.ready[self.message_id] = self.separator.join(self.parts)
+
+    # returns the (message, text) pairs packed since the last call, with
+    # only the latest text of a message edited several times meanwhile
+    def take(self):
+        ready, self.ready = self.ready, collections.OrderedDict()
+        return list(ready.items())
+
+
+# Created on startup, in the event loop, by start()
+spark = None
+web_session = None
+executor = None
+job_slots = None
+running = set()
+waiting = 0
+
+# waits for a turn of an app.RateLimiter without holding a thread, checking
+# again every 50ms while all the calls allowed are in flight
+async def acquire(limiter):
+    deadline = time.time() + limiter.max_wait
+    throttled = False
+    while True:
+        with limiter.condition:
+            now = time.time()
+            delay = limiter.take(now)
+            if delay == 0:
+                return
+            if now >= deadline:
+                raise limiter.drop()
+            if not throttled:
+                throttled = True
+                limiter.throttle()
+        await asyncio.sleep(min(deadline - now, delay or 0.05))
+
+# runs a blocking function on the executor, keeping the trace of the task
+def run_blocking(func, *args):
+    context = contextvars.copy_context()
+    return asyncio.get_event_loop().run_in_executor(executor, functools.partial(context.run, func, *args))
+
+# runs a short blocking call, e.g. to a disk cache, on the default executor
+# of the loop, so that answering Spark never waits behind the analyses
+def run_quick(func, *args):
+    return asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+# reads the streamed body of an image download, like app.read_image
+async def read_image(response, max_bytes):
+    image = app.ImageBuffer(max_bytes, response.headers.get('Content-Length'))
+    async for chunk in response.content.iter_chunked(64 * 1024):
+        if not image.write(chunk):
+            logging.info("Not fetching %s, not an image", response.url)
+            return None
+    return image.getvalue()
+
+# reads the body of a file download, None without reading it unless the
+# headers announce an image
+async def read_file(response):
+    if not app.is_image_type(response.headers):
+        return None
+    return await read_image(response, app.file_max_bytes)
+
+# downloads the image an URL points to, None if it is not an acceptable image
+async def fetch_image(url):
+    """Fetches an image in a single streamed GET, like app.fetch_image."""
+    timeout = aiohttp.ClientTimeout(total=app.url_timeout)
+    async with web_session.get(url, timeout=timeout) as response:
+        if response.status != 200:
+            logging.info("Fetching %s failed: %s", url, response.status)
+            return None
+        return await read_image(response, app.url_max_bytes)
+
+# resizes an image, run on the executor, returns it with its perceptual hash
+def resize(content):
+    hashes = {}
+    with app.timed('resize'):
+        content = app.resize_image(content, app.base_img_width, hashes=hashes)
+    return content, hashes.get('dhash')
+
+# downloads and analyses a file posted to the room, returns the texts to post
+async def analyze_file(item, get_features):
+    response = await spark.download(item)
+    if response.status != 200:
+        return []
+
+    if response.body is None:
+        return ["Ahoy! Thanks for sending me your \
+            file. However, I only analyze images."]
+
+    content, image_hash = await run_blocking(resize, response.body)
+
+    #Analyse image with Google Vision API
+    features = await get_features()
+    result = await run_blocking(app.analyze_image_similar, content, image_hash, features)
+    return app.render_post(result) + [app.project_info]
+
+# analyses the image an URL points to, returns the texts to post
+async def analyze_url(url, get_features):
+    features = await get_features()
+    key = app.url_cache_key(url, features)
+    result = await run_blocking(app.cached_result, key)
+
+    if result is None:
+        with app.timed('url_fetch', 'web'):
+            content = await fetch_image(url)
+
+        #Only send the image to Google Vision API if url is an image
+        if content is None:
+            return ["Ahoy! Thanks for sending me your \
+                url. However, I only analyze images."]
+
+        content, image_hash = await run_blocking(resize, content)
+        result = await run_blocking(app.analyze_image_similar, content, image_hash, features)
+        if not result.error:
+            await run_blocking(app.results.set, key, result.to_dict())
+
+    return app.render_post(result) + [app.project_info]
+
+# get more specific information about the message that triggered the webhook
+async def get_message_details(messageID):
+    message = app.message_details.get(messageID)
+    if message is None:
+        message = json.loads(await spark.get_message_details(messageID))
+        app.message_details.set(messageID, message)
+    return message
+
+# posts the messages taken from a MessagePacker, or edits those already posted
+async def post_messages(roomID, messages):
+    for message, text in messages:
+        if message.id is not None:
+            await spark.edit_message(message.id, roomID, text)
+            continue
+        resp = await spark.post_message(roomID, text)
+        if resp.status == 200:
+            message.id = json.loads(resp.body.decode('utf-8')).get('id')
+
+# analyses the image files or image URLs of a webhook and posts the results
+async def process_webhook(data):
+    messageID = data['data']['id']
+    roomID = data['data']['roomId']
+    app.trace.message_id = messageID
+
+    # Results are packed into as few messages as possible
+    packer = MessagePacker(app.spark_max_message_bytes, app.spark_streaming_messages)
+
+    if 'files' in data['data']:
+        items = data['data']['files']
+        analyze_item = analyze_file
+
+        # The text may name the features to analyse, fetch it while the
+        # files download
+        details = asyncio.ensure_future(get_message_details(messageID))
+
+        async def get_features():
+            await asyncio.wait([details])
+            return await run_blocking(app.file_features, messageID, roomID, details)
+
+    else:
+        # Only the message text is missing from the webhook, fetch it
+        details = None
+        message = await get_message_details(messageID)
+        text = message.get('text', '')
+        items, reply = await run_blocking(app.read_message, roomID, text)
+        analyze_item = analyze_url
+
+        async def get_features():
+            return await run_blocking(app.request_features, roomID, text)
+
+        if reply is not None:
+            packer.add(reply)
+
+    # Items are analysed concurrently but reported in the order they were posted
+    item_slots = asyncio.Semaphore(app.message_item_concurrency)
+
+    async def analyze(item):
+        async with item_slots:
+            return await analyze_item(item, get_features)
+
+    tasks = [asyncio.ensure_future(analyze(item)) for item in items]
+    try:
+        for item, task in zip(items, tasks):
+            try:
+                texts = await task
+            except app.ImageTooLarge as error:
+                logging.info("Not analysing %s, %s", item, error)
+                texts = [app.too_large_msg]
+            except Exception:
+                logging.exception("Analysing %s failed", item)
+                texts = ["Sorry, I could not analyze " + item + "."]
+            for text in texts:
+                packer.add(text)
+            await post_messages(roomID, packer.take())
+
+        packer.close()
+        await post_messages(roomID, packer.take())
+    finally:
+        for task in tasks:
+            task.cancel()
+        if details is not None:
+            # A failed fetch no file needed is not an unretrieved exception
+            if details.done() and not details.cancelled():
+                details.exception()
+            details.cancel()
+
+# runs a webhook job once one of the async_max_jobs slots is free
+async def run_job(messageID, data):
+    global waiting
+    enqueued = time.time()
+    waiting += 1
+    try:
+        await job_slots.acquire()
+    finally:
+        waiting -= 1
+
+    started = time.time()
+    rss_before = app.peak_rss()
+    failed = False
+    try:
+        await process_webhook(data)
+    except Exception:
+        failed = True
+        logging.exception("Job %s failed", messageID)
+    finally:
+        job_slots.release()
+    processing = time.time() - started
+
+    app.metrics.observe('stage_seconds', started - enqueued, stage='queue_wait')
+    app.metrics.observe('stage_seconds', processing, stage='job')
+    app.metrics.inc('jobs_total', status='failed' if failed else 'completed')
+    app.log_job(messageID, started - enqueued, processing, rss_before, app.peak_rss())
+
+# aiohttp route receiving the webhooks from Spark
+async def listener(request):
+    # On receipt of a POST (webhook), load the JSON data from the request
+    try:
+        data = json.loads((await request.read()).decode('utf-8'))
+        messageID = data['data']['id']
+        # The room is used later on, check that there is one
+        data['data']['roomId']
+        actorID = data['actorId']
+    except (ValueError, KeyError, TypeError):
+        return web.Response(status=400, text="Invalid webhook payload")
+
+    # If the poster of the message was the bot itself, there is nothing to do
+    if actorID == app.bot_id:
+        app.metrics.inc('webhooks_skipped_total', reason='bot')
+        return web.Response(text="OK")
+
+    # Spark retries and duplicate deliveries are only analysed once
+    if await run_quick(app.seen_messages.seen, messageID):
+        app.metrics.inc('webhooks_skipped_total', reason='duplicate')
+        logging.info("Skipping duplicate delivery of message %s", messageID)
+        return web.Response(text="OK")
+
+    # Push back on Spark once too many jobs wait for a slot
+    if waiting >= async_queue_size:
+        logging.warning("Too many jobs waiting, rejecting job %s", messageID)
+        await run_quick(app.seen_messages.forget, messageID)
+        return web.Response(status=503, text="Busy")
+
+    # Analyse in the background so Spark gets its answer before it times out
+    job = asyncio.ensure_future(run_job(messageID, data))
+    running.add(job)
+    job.add_done_callback(running.discard)
+    return web.Response(text="OK")
+
+def job_stats():
+    return {
+        'running': len(running) - waiting,
+        'waiting': waiting,
+        'max_jobs': async_max_jobs,
+    }
+
+# reports job and Google Vision client statistics
+async def stats(request):
+    report = await run_quick(app.stats_report, job_stats())
+    return web.Response(content_type='application/json', text=json.dumps(report))
+
+# exposes stage latencies, error counts and statistics to Prometheus
+async def prometheus_metrics(request):
+    text = await run_quick(app.metrics.render)
+    return web.Response(body=text.encode('utf-8'),
+        headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+# creates the sessions and pools of the event loop
+async def start(application):
+    global spark, web_session, executor, job_slots
+
+    connector = aiohttp.TCPConnector(limit=async_connections)
+    # sock_connect tells connection timeouts, which POSTs retry, from others
+    timeout = aiohttp.ClientTimeout(total=app.spark_timeout, sock_connect=app.spark_timeout)
+    spark_session = aiohttp.ClientSession(connector=connector, timeout=timeout,
+        headers=app.set_headers(app.bot_token))
+    spark = AsyncSparkClient(spark_session, app.spark.base_url, app.spark_retries, app.spark.limiter)
+
+    # Session without the bot credentials, for images posted as URLs
+    web_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=async_connections))
+
+    executor = futures.ThreadPoolExecutor(max_workers=async_executor_threads)
+    # Every executor thread can be analysing an image and fanning out one
+    # Vision call per feature
+    if not app.vision_fanout_workers:
+        app.vision_fanout = futures.ThreadPoolExecutor(
+            max_workers=async_executor_threads * len(app.vision_features))
+    job_slots = asyncio.Semaphore(async_max_jobs)
+
+    app.metrics.register(lambda: [('async_jobs_' + stat, {}, value)
+                                  for stat, value in sorted(job_stats().items())])
+
+async def stop(application):
+    for job in list(running):
+        job.cancel()
+    await spark.session.close()
+    await web_session.close()
+    executor.shutdown(wait=False)
+
+# builds the aiohttp application listening for webhooks from Spark
+def create_app():
+    application = web.Application()
+    application.router.add_post('/', listener)
+    application.router.add_get('/stats', stats)
+    application.router.add_get('/metrics', prometheus_metrics)
+    application.on_startup.append(start)
+    application.on_cleanup.append(stop)
+    return application
+
+
+if __name__ == '__main__':
+    app.configure_logging()
+
+    #get ngrok tunnel details and update webhook
+    app.register_webhook_in_background()
+
+    #warm up the Google Vision client before the first webhook arrives
+    app.warm_up_in_background()
+    app.report_startup()
+
+    #launching main application
+    print ("Launching async spark bot application")
+    web.run_app(create_app(), port=8080)
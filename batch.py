@@ -0,0 +1,224 @@
+#
+#       Offline batch analysis of archived images with Google Vision
+#
+#   USAGE:
+#       python batch.py SOURCE [--output FILE] [--features text macs ...]
+#                       [--batch-size N] [--concurrency C]
+#
+#       SOURCE is a directory, whose image files are analysed recursively,
+#       or a manifest file listing one image path or URL per line. Images
+#       are sent to Google Vision N at a time (16 at most) in a single
+#       annotate request, with C requests in flight. Local files are resized
+#       like images posted to the Bot, URLs (http, https or gs://) are
+#       fetched by Google Vision itself.
+#
+#       Results are appended to FILE as soon as each batch completes, as JSON
+#       lines or as CSV when FILE ends with .csv. Running the same command
+#       again resumes an interrupted run: the images already analysed in FILE
+#       are skipped, those that failed are tried again. Progress and
+#       throughput, in images per second, are printed every few seconds.
+#
+
+
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import sys
+import time
+from concurrent import futures
+
+import app
+
+logging.getLogger().setLevel(logging.WARNING)
+
+# Largest number of images Google Vision accepts in one annotate request
+max_batch_size = 16
+
+image_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp', '.ico')
+
+# lists the images of a directory, or the paths and URLs of a manifest
+def list_sources(source):
+    if os.path.isdir(source):
+        sources = []
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(image_extensions):
+                    sources.append(os.path.join(root, name))
+        return sources
+
+    with io.open(source, 'r', encoding='utf-8') as manifest:
+        lines = [line.strip() for line in manifest]
+    return [line for line in lines if line and not line.startswith('#')]
+
+def is_uri(source):
+    return source.startswith(('http://', 'https://', 'gs://'))
+
+# builds the Vision image of a path or URL
+def load_image(source):
+    if is_uri(source):
+        return app.load_image_uri(source)
+
+    if os.path.getsize(source) > app.file_max_bytes:
+        raise app.ImageTooLarge("more than {} bytes".format(app.file_max_bytes))
+    with io.open(source, 'rb') as image_file:
+        content = image_file.read()
+    if app.sniff_image_type(content[:16]) is None:
+        raise ValueError("not an image")
+    return app.types.Image(content=app.resize_image(content, app.base_img_width))
+
+# turns the Vision response of an image into a result record
+def make_record(source, response, features):
+    if response.error.message:
+        return {'source': source, 'error': response.error.message, 'result': None}
+    return {'source': source, 'error': None, 'result': app.parse_response(response, features).to_dict()}
+
+# analyses a batch of images with a single Vision call, returns their records
+def analyze_batch(sources, features):
+    records = {}
+    images = []
+    for source in sources:
+        try:
+            images.append((source, load_image(source)))
+        except (IOError, ValueError) as error:
+            records[source] = {'source': source, 'error': str(error), 'result': None}
+
+    requested = app.vision_request_features(features)
+    if images and requested:
+        try:
+            responses = app.annotate_images([image for source, image in images], requested)
+        except Exception as error:
+            logging.exception("Analysing a batch of %d images failed", len(images))
+            for source, image in images:
+                records[source] = {'source': source, 'error': str(error), 'result': None}
+        else:
+            for (source, image), response in zip(images, responses):
+                records[source] = make_record(source, response, features)
+
+    return [records[source] for source in sources if source in records]
+
+
+class ResultWriter(object):
+    """Appends result records to a JSON lines file, or to a CSV file when
+    path ends with .csv. CSV files have a column per feature, holding the
+    summary of its top items, and every MAC address found."""
+
+    def __init__(self, path, features, top):
+        self.path = path
+        self.csv = path.lower().endswith('.csv')
+        self.columns = ['source', 'error'] + list(features)
+        self.top = top
+        self.file = None
+        self.writer = None
+
+    # lists the sources analysed by a previous run, failed ones are tried again
+    def done(self):
+        if not os.path.exists(self.path):
+            return set()
+
+        sources = set()
+        with io.open(self.path, 'r', encoding='utf-8', newline='') as results_file:
+            if self.csv:
+                for row in csv.DictReader(results_file):
+                    if not row['error']:
+                        sources.add(row['source'])
+            else:
+                for line in results_file:
+                    try:
+                        record = json.loads(line)
+                        if not record['error']:
+                            sources.add(record['source'])
+                    except (ValueError, KeyError):
+                        # An interrupted run may have left half a line
+                        pass
+        return sources
+
+    def open(self):
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self.file = io.open(self.path, 'a', encoding='utf-8', newline='')
+        if self.csv:
+            self.writer = csv.DictWriter(self.file, self.columns, extrasaction='ignore')
+            if new:
+                self.writer.writeheader()
+
+    def write(self, records):
+        for record in records:
+            if self.csv:
+                row = {'source': record['source'], 'error': record['error'] or ''}
+                if record['result'] is not None:
+                    result = app.AnalysisResult.from_dict(record['result'])
+                    row.update(app.summarize(result, self.top))
+                    row['macs'] = ' '.join(result.macs or [])
+                self.writer.writerow(row)
+            else:
+                self.file.write(json.dumps(record) + '\n')
+        # Flushed after every batch, so an interrupted run can be resumed
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def report(done, total, errors, started):
+    elapsed = time.time() - started
+    print('{}/{} images, {} errors, {:.1f}s, {:.1f} images/s'.format(
+        done, total, errors, elapsed, done / elapsed if elapsed else 0.0), file=sys.stderr)
+
+def run(args):
+    if args.features:
+        features = app.parse_features(' '.join(args.features)) or app.default_features
+    else:
+        features = app.default_features
+    batch_size = max(1, min(max_batch_size, args.batch_size))
+
+    writer = ResultWriter(args.output, features, args.top)
+    done = writer.done()
+    sources = [source for source in list_sources(args.source) if source not in done]
+    if done:
+        print('Resuming, {} images already analysed'.format(len(done)), file=sys.stderr)
+
+    batches = [sources[i:i + batch_size] for i in range(0, len(sources), batch_size)]
+    analysed = 0
+    errors = 0
+    started = reported = time.time()
+
+    writer.open()
+    try:
+        with futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            pending = set()
+            for batch in batches + [None]:
+                # Keep at most two batches per thread submitted, so images
+                # are only loaded shortly before they are analysed
+                while pending and (batch is None or len(pending) >= 2 * args.concurrency):
+                    finished, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                    for future in finished:
+                        records = future.result()
+                        writer.write(records)
+                        analysed += len(records)
+                        errors += sum(1 for record in records if record['error'])
+
+                    if time.time() - reported >= args.report_interval:
+                        report(analysed, len(sources), errors, started)
+                        reported = time.time()
+
+                if batch is not None:
+                    pending.add(executor.submit(analyze_batch, batch, features))
+    finally:
+        writer.close()
+
+    report(analysed, len(sources), errors, started)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analyse archived images with Google Vision.')
+    parser.add_argument('source', help='directory of images, or manifest file of image paths and URLs')
+    parser.add_argument('--output', default='results.jsonl', help='results file, .jsonl or .csv')
+    parser.add_argument('--features', nargs='*', help='features to analyse, e.g. text macs (default: default_features)')
+    parser.add_argument('--batch-size', type=int, default=max_batch_size, help='images per Vision request')
+    parser.add_argument('--concurrency', type=int, default=4, help='Vision requests in flight')
+    parser.add_argument('--top', type=int, default=10, help='items of each feature in CSV files')
+    parser.add_argument('--report-interval', type=float, default=10.0, help='seconds between progress reports')
+    run(parser.parse_args())
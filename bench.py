@@ -0,0 +1,526 @@
+#
+#       Benchmarks for the Spark Bot, run against local stand-ins for the
+#       Google Vision and Spark APIs so no real endpoint is called.
+#
+#   USAGE:
+#       python bench.py replay [--requests N] [--rate R] [--payloads FILE]
+#                              [--pipeline sync|async|both] [--memory-budget MB]
+#       python bench.py micro
+#
+#       replay posts webhook payloads to the Flask app at R requests per
+#       second and reports webhook and end-to-end job latencies, throughput,
+#       Vision and Spark call counts and peak memory. Payloads are read from
+#       FILE (one recorded webhook JSON per line) or generated. With
+#       --pipeline both, the same webhooks are replayed through the Flask app
+#       and then through the asyncio variant of async_app.py, which is
+#       served over local HTTP, so its acknowledge latency includes a round
+#       trip the Flask test client does not make. --memory-budget sets the
+#       image_memory_budget, to compare peak memory and latencies with
+#       larger --image-width and --image-height images.
+#
+#       micro times image preprocessing, MAC extraction, the parsing of
+#       Vision responses and the rendering of results.
+#
+
+
+import argparse
+import collections
+import io
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, urlunsplit
+
+# Fall back to the template settings, the stand-ins do not need real ones
+try:
+    import settings
+except ImportError:
+    import settings_template
+    sys.modules['settings'] = settings_template
+
+from google.cloud.vision import types
+from PIL import Image
+
+import app
+
+logging.getLogger().setLevel(logging.WARNING)
+
+# encodes a noisy test image, noise keeps JPEG and PNG sizes realistic
+def make_image(width, height, img_format='JPEG', seed=0):
+    random.seed(seed)
+    img = Image.effect_noise((width, height), 40).convert('RGB')
+    img = Image.blend(img, Image.new('RGB', (width, height), (random.randint(0, 255), 90, 160)), 0.5)
+    buffer = io.BytesIO()
+    img.save(buffer, format=img_format)
+    return buffer.getvalue()
+
+# builds a Vision response with a bit of everything
+def make_response(words=200, matches=20):
+    response = types.AnnotateImageResponse()
+
+    text = []
+    for i in range(words):
+        text.append('00:1a:2b:3c:4d:{:02x}'.format(i % 256) if i % 10 == 0 else 'word{}'.format(i))
+    full_text = response.text_annotations.add()
+    full_text.description = ' '.join(text)
+    for i, word in enumerate(text):
+        annotation = response.text_annotations.add()
+        annotation.description = word
+        for x, y in ((0, 0), (10, 0), (10, 10), (0, 10)):
+            vertex = annotation.bounding_poly.vertices.add()
+            vertex.x, vertex.y = x + i, y + i
+
+    for i in range(3):
+        face = response.face_annotations.add()
+        face.joy_likelihood = 5
+        for x, y in ((0, 0), (50, 0), (50, 50), (0, 50)):
+            vertex = face.bounding_poly.vertices.add()
+            vertex.x, vertex.y = x, y
+
+    for i in range(10):
+        label = response.label_annotations.add()
+        label.description = 'label {}'.format(i)
+        label.score = 1.0 - i / 20.0
+    response.landmark_annotations.add().description = 'Eiffel Tower'
+    response.logo_annotations.add().description = 'Cisco'
+
+    notes = response.web_detection
+    for i in range(matches):
+        notes.pages_with_matching_images.add().url = 'https://example.com/page/{}'.format(i)
+        notes.full_matching_images.add().url = 'https://example.com/full/{}.jpg'.format(i)
+        notes.partial_matching_images.add().url = 'https://example.com/partial/{}.jpg'.format(i)
+        entity = notes.web_entities.add()
+        entity.description = 'entity {}'.format(i)
+        entity.score = 1.0 - i / 40.0
+
+    return response
+
+
+# Fields of a Vision response holding the results of each feature
+response_fields = {
+    'faces': ('face_annotations',),
+    'landmarks': ('landmark_annotations',),
+    'logos': ('logo_annotations',),
+    'labels': ('label_annotations',),
+    'text': ('text_annotations',),
+    'web': ('web_detection.web_entities', 'web_detection.full_matching_images',
+            'web_detection.partial_matching_images', 'web_detection.pages_with_matching_images'),
+}
+
+# keeps the results of the requested features of a canned response, up to
+# their max_results like Google Vision does
+def answer_request(request, canned):
+    feature_names = dict((getattr(app.vision.enums.Feature.Type, value), name)
+                         for name, value in app.feature_types.items())
+    response = types.AnnotateImageResponse()
+    for feature in request.features:
+        for path in response_fields[feature_names[feature.type]]:
+            source, target = canned, response
+            for name in path.split('.'):
+                source, target = getattr(source, name), getattr(target, name)
+            # Vision ignores max_results for text detection
+            items = list(source)
+            if feature.max_results and path != 'text_annotations':
+                items = items[:feature.max_results]
+            target.extend(items)
+    return response
+
+
+class FakeImageAnnotatorClient(object):
+    """Stands in for vision.ImageAnnotatorClient, answering every annotate
+    request with the requested results of a canned response after a fixed
+    latency."""
+
+    calls = 0
+    images = 0
+    response_bytes = 0
+    lock = threading.Lock()
+
+    def __init__(self, latency, response):
+        self.latency = latency
+        self.response = response
+
+    def batch_annotate_images(self, requests, options=None):
+        responses = [answer_request(request, self.response) for request in requests]
+        with self.lock:
+            FakeImageAnnotatorClient.calls += 1
+            FakeImageAnnotatorClient.images += len(requests)
+            FakeImageAnnotatorClient.response_bytes += sum(response.ByteSize() for response in responses)
+        time.sleep(self.latency)
+        return types.BatchAnnotateImagesResponse(responses=responses)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeSparkHandler(BaseHTTPRequestHandler):
+    """Answers the Spark REST calls of the bot and serves the posted files
+    and image URLs."""
+
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    kb_latency = 0.0
+    image = b''
+    calls = collections.Counter()
+    posted_bytes = 0
+    lock = threading.Lock()
+
+    def count(self):
+        with self.lock:
+            self.calls[self.command + ' ' + self.path.split('/')[1]] += 1
+        time.sleep(self.latency)
+
+    def reply(self, body, content_type='application/json', headers=None):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    # reads a posted body, taking longer for larger ones
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.lock:
+            FakeSparkHandler.posted_bytes += len(body)
+        time.sleep(self.kb_latency * len(body) / 1024.0)
+        return body
+
+    def do_GET(self):
+        self.count()
+        if self.path.startswith('/messages/'):
+            message_id = self.path.split('/')[-1]
+            text = 'look at http://{}:{}/images/{}.jpg'.format(
+                self.server.server_name, self.server.server_port, message_id)
+            self.reply(json.dumps({'id': message_id, 'text': text}).encode('utf-8'))
+        else:
+            self.reply(self.image, 'image/jpeg',
+                {'Content-Disposition': 'attachment; filename="image.jpg"'})
+
+    def do_POST(self):
+        self.count()
+        self.read_body()
+        self.reply(json.dumps({'id': 'posted'}).encode('utf-8'))
+
+    def do_PUT(self):
+        self.count()
+        self.read_body()
+        self.reply(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+# starts the fake Spark API and points the bot to it and to the fake Vision
+def install_stand_ins(vision_latency, spark_latency, image, response=None, spark_kb_latency=0.0):
+    FakeSparkHandler.latency = spark_latency
+    FakeSparkHandler.kb_latency = spark_kb_latency
+    FakeSparkHandler.image = image
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSparkHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+    app.spark = app.SparkClient(app.bot_token, base_url, app.spark_timeout,
+        app.spark_retries, app.spark_pool_size, app.spark_limiter)
+
+    response = response or make_response()
+    app.vision_clients.factory = lambda: FakeImageAnnotatorClient(vision_latency, response)
+    app.vision_clients.reset()
+    return base_url
+
+# generates webhook payloads alternating between file uploads and URLs
+def generate_payloads(count, base_url):
+    payloads = []
+    for i in range(count):
+        data = {'id': 'msg-{}'.format(i), 'roomId': 'room-{}'.format(i % 5)}
+        if i % 2 == 0:
+            data['files'] = [base_url + '/files/{}'.format(i)]
+        payloads.append({'actorId': 'someone', 'data': data})
+    return payloads
+
+# reads recorded payloads, pointing their file URLs at the Spark stand-in so
+# that no file is downloaded from Spark itself
+def load_payloads(path, count, base_url):
+    scheme, netloc = urlsplit(base_url)[:2]
+    with io.open(path, 'r', encoding='utf-8') as payload_file:
+        payloads = [json.loads(line) for line in payload_file if line.strip()]
+    for payload in payloads:
+        data = payload.get('data', {})
+        if 'files' in data:
+            data['files'] = [urlunsplit((scheme, netloc) + urlsplit(url)[2:]) for url in data['files']]
+    return [payloads[i % len(payloads)] for i in range(count)]
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+# mean duration of a processing stage, from the metrics of the app
+def mean_stage_seconds(stage):
+    histogram = app.metrics.histograms.get(('stage_seconds', (('stage', stage),)))
+    if not histogram or not histogram[-2]:
+        return 0.0
+    return histogram[-1] / histogram[-2]
+
+def print_latencies(name, values):
+    print('{:<22} p50 {:8.1f} ms   p95 {:8.1f} ms   p99 {:8.1f} ms'.format(name,
+        percentile(values, 50) * 1000, percentile(values, 95) * 1000, percentile(values, 99) * 1000))
+
+
+# posts payloads at the requested rate with post(payload), returning the
+# acknowledge latencies and statuses
+def send_payloads(payloads, rate, post, arrivals, lock):
+    webhook_latencies = []
+    statuses = collections.Counter()
+    started = time.time()
+    for i, payload in enumerate(payloads):
+        # Keep to the requested rate
+        delay = started + i / float(rate) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        payload = dict(payload, data=dict(payload['data'], id='{}-{}'.format(payload['data']['id'], i)))
+        with lock:
+            arrivals[payload['data']['id']] = time.time()
+        sent = time.time()
+        status = post(payload)
+        webhook_latencies.append(time.time() - sent)
+        statuses[status] += 1
+        if status != 200:
+            with lock:
+                arrivals.pop(payload['data']['id'])
+    return webhook_latencies, statuses
+
+# replays payloads through the Flask app and its job queue
+def replay_sync(args, payloads):
+    # Measure end-to-end job latency from webhook arrival to last post
+    arrivals = {}
+    job_latencies = []
+    process_webhook = app.process_webhook
+    lock = threading.Lock()
+
+    def timed_process_webhook(data):
+        try:
+            process_webhook(data)
+        finally:
+            with lock:
+                job_latencies.append(time.time() - arrivals[data['data']['id']])
+    app.process_webhook = timed_process_webhook
+
+    client = app.app.test_client()
+    started = time.time()
+    webhook_latencies, statuses = send_payloads(payloads, args.rate,
+        lambda payload: client.post('/', data=json.dumps(payload)).status_code, arrivals, lock)
+
+    app.jobs.queue.join()
+    elapsed = time.time() - started
+    app.process_webhook = process_webhook
+    return webhook_latencies, job_latencies, statuses, elapsed, app.jobs.stats()
+
+# replays payloads over HTTP through the aiohttp app of async_app.py,
+# served by an event loop in a background thread
+def replay_async(args, payloads):
+    import asyncio
+    import requests
+    from aiohttp import web
+    import async_app
+
+    arrivals = {}
+    job_latencies = []
+    process_webhook = async_app.process_webhook
+    lock = threading.Lock()
+    done = threading.Condition(lock)
+
+    async def timed_process_webhook(data):
+        try:
+            await process_webhook(data)
+        finally:
+            with lock:
+                job_latencies.append(time.time() - arrivals[data['data']['id']])
+                done.notify_all()
+    async_app.process_webhook = timed_process_webhook
+
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(async_app.create_app())
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever)
+    thread.daemon = True
+    thread.start()
+
+    session = requests.Session()
+    url = 'http://127.0.0.1:{}/'.format(port)
+    started = time.time()
+    webhook_latencies, statuses = send_payloads(payloads, args.rate,
+        lambda payload: session.post(url, data=json.dumps(payload)).status_code, arrivals, lock)
+
+    with lock:
+        while len(job_latencies) < len(arrivals):
+            done.wait()
+    elapsed = time.time() - started
+    job_stats = async_app.job_stats()
+
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    async_app.process_webhook = process_webhook
+    return webhook_latencies, job_latencies, statuses, elapsed, job_stats
+
+def replay(args):
+    image = make_image(args.image_width, args.image_height)
+    pipelines = ('sync', 'async') if args.pipeline == 'both' else (args.pipeline,)
+
+    for pipeline in pipelines:
+        # Every pipeline starts from fresh caches, pools and counters
+        app.init_worker()
+        base_url = install_stand_ins(args.vision_latency, args.spark_latency, image,
+            make_response(args.words, args.matches), args.spark_kb_latency)
+        FakeImageAnnotatorClient.calls = FakeImageAnnotatorClient.images = 0
+        FakeImageAnnotatorClient.response_bytes = FakeSparkHandler.posted_bytes = 0
+        FakeSparkHandler.calls.clear()
+        if args.no_cache:
+            app.results = app.ResultCache(0, 0)
+        if args.no_limits:
+            app.feature_limits = {}
+        if args.memory_budget is not None:
+            app.image_memory = app.MemoryBudget(args.memory_budget * 1024 * 1024)
+
+        if args.payloads:
+            payloads = load_payloads(args.payloads, args.requests, base_url)
+        else:
+            payloads = generate_payloads(args.requests, base_url)
+
+        tracemalloc.start()
+        if pipeline == 'sync':
+            results = replay_sync(args, payloads)
+        else:
+            results = replay_async(args, payloads)
+        webhook_latencies, job_latencies, statuses, elapsed, job_stats = results
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print('[{}] Replayed {} webhooks at {} req/s in {:.2f}s, statuses {}'.format(
+            pipeline, len(payloads), args.rate, elapsed, dict(statuses)))
+        print_latencies('webhook acknowledge', webhook_latencies)
+        print_latencies('end-to-end job', job_latencies)
+        print('throughput             {:.1f} jobs/s'.format(len(job_latencies) / elapsed))
+        print('vision calls           {} ({} images, {:.1f} KB of responses)'.format(
+            FakeImageAnnotatorClient.calls, FakeImageAnnotatorClient.images,
+            FakeImageAnnotatorClient.response_bytes / 1024.0))
+        print('spark calls            {} {}'.format(sum(FakeSparkHandler.calls.values()), dict(FakeSparkHandler.calls)))
+        print('spark posts            {:.1f} KB, {:.1f} ms per post'.format(
+            FakeSparkHandler.posted_bytes / 1024.0, mean_stage_seconds('spark_post_message') * 1000))
+        # The peak RSS is that of the whole process, since it started
+        rss = app.peak_rss()
+        print('peak memory            {:.1f} MB traced, {} max RSS{}'.format(peak_traced / 1048576.0,
+            'n/a' if rss is None else '{:.1f} MB'.format(rss / 1048576.0),
+            ' (process-wide, includes the runs above)' if pipeline != pipelines[0] else ''))
+        image_memory = app.image_memory.stats()
+        print('image memory           {:.1f} MB peak reserved, {} queued, {:.2f}s waited'.format(
+            image_memory['peak'] / 1048576.0, image_memory['queued'], image_memory['total_wait']))
+        print('threads                {}'.format(threading.active_count()))
+        print('stats                  {}'.format(json.dumps({'jobs': job_stats, 'results': app.results.stats()})))
+        print('')
+
+
+# times func over repeat runs and prints the best and mean run times
+def timeit(name, func, repeat):
+    runs = []
+    for i in range(repeat):
+        started = time.time()
+        func()
+        runs.append(time.time() - started)
+    print('{:<40} best {:8.2f} ms   mean {:8.2f} ms'.format(
+        name, min(runs) * 1000, sum(runs) / len(runs) * 1000))
+
+def micro(args):
+    for width, height, img_format in ((4032, 3024, 'JPEG'), (1920, 1080, 'JPEG'),
+                                      (2880, 1800, 'PNG'), (800, 600, 'JPEG')):
+        content = make_image(width, height, img_format)
+        timeit('resize_image {} {}x{} ({} KB)'.format(img_format, width, height, len(content) // 1024),
+            lambda: app.resize_image(content, app.base_img_width), args.repeat)
+
+    response = make_response(words=args.words, matches=args.matches)
+    text = response.text_annotations[0].description
+    timeit('extract_mac_addresses ({} words)'.format(args.words),
+        lambda: app.extract_mac_addresses(text), args.repeat)
+
+    for name, parse, render, title in app.feature_handlers:
+        timeit('parse {}'.format(name), lambda: parse(response), args.repeat)
+
+    result = app.parse_response(response, app.all_features)
+    for name, parse, render, title in app.feature_handlers:
+        timeit('render {}'.format(name), lambda: render(getattr(result, name)), args.repeat)
+    timeit('render summary', lambda: app.render_summary(result), args.repeat)
+    timeit('render json', lambda: app.render_json(result), args.repeat)
+    timeit('cache round trip', lambda: app.AnalysisResult.from_dict(result.to_dict()), args.repeat)
+
+    print('markdown result size                     {} bytes'.format(
+        len('\n\n'.join(app.format_sections(app.render_markdown(result))).encode('utf-8'))))
+
+    # The same response as Vision returns it without and with feature_limits
+    feature_limits = app.feature_limits
+    for name, limits in (('unlimited', {}), ('limited', feature_limits)):
+        app.feature_limits = limits
+        request = types.AnnotateImageRequest(features=[
+            types.Feature(type=app.feature_types[feature], max_results=app.vision_max_results(feature))
+            for feature in app.vision_features])
+        limited_response = answer_request(request, response)
+        timeit('parse and render {}'.format(name), lambda: app.format_sections(
+            app.render_markdown(app.parse_response(limited_response, app.all_features))), args.repeat)
+        print('{:<40} {} bytes response, {} bytes markdown'.format(name + ' result size', limited_response.ByteSize(),
+            len('\n\n'.join(app.format_sections(app.render_markdown(
+                app.parse_response(limited_response, app.all_features)))).encode('utf-8'))))
+    app.feature_limits = feature_limits
+    print('summary result size                      {} bytes'.format(
+        len('\n\n'.join(app.format_sections(app.render_summary(result))).encode('utf-8'))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Spark Bot against local stand-ins.')
+    commands = parser.add_subparsers(dest='command')
+
+    replay_parser = commands.add_parser('replay', help='replay webhooks through the Flask or aiohttp app')
+    replay_parser.add_argument('--requests', type=int, default=100)
+    replay_parser.add_argument('--rate', type=float, default=20.0, help='webhooks per second')
+    replay_parser.add_argument('--payloads', help='file of recorded webhook payloads, one JSON per line')
+    replay_parser.add_argument('--vision-latency', type=float, default=0.3)
+    replay_parser.add_argument('--spark-latency', type=float, default=0.05)
+    replay_parser.add_argument('--image-width', type=int, default=3000)
+    replay_parser.add_argument('--image-height', type=int, default=2000)
+    replay_parser.add_argument('--no-cache', action='store_true', help='disable the result cache')
+    replay_parser.add_argument('--spark-kb-latency', type=float, default=0.001,
+        help='additional Spark latency per KB posted')
+    replay_parser.add_argument('--words', type=int, default=200, help='words detected in the image')
+    replay_parser.add_argument('--matches', type=int, default=20, help='web matches found for the image')
+    replay_parser.add_argument('--no-limits', action='store_true', help='disable the feature_limits caps')
+    replay_parser.add_argument('--memory-budget', type=int, help='image_memory_budget in MB')
+    replay_parser.add_argument('--pipeline', choices=('sync', 'async', 'both'), default='sync',
+        help='replay through app.py, async_app.py or both, one after the other')
+    replay_parser.set_defaults(func=replay)
+
+    micro_parser = commands.add_parser('micro', help='time preprocessing and formatting')
+    micro_parser.add_argument('--repeat', type=int, default=10)
+    micro_parser.add_argument('--words', type=int, default=500)
+    micro_parser.add_argument('--matches', type=int, default=20)
+    micro_parser.set_defaults(func=micro)
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+    else:
+        args.func(args)
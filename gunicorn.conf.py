@@ -0,0 +1,43 @@
+#
+#       Production server configuration for the Spark Bot
+#
+#   USAGE:
+#       pip install gunicorn
+#       gunicorn -c gunicorn.conf.py
+#
+#       The application is imported once by the master process, which also
+#       updates the Spark webhook with the ngrok tunnel details, in the
+#       background and retrying until ngrok answers. Each worker process then
+#       creates its own clients, caches, pools and job queue after it is
+#       forked.
+#
+
+
+import multiprocessing
+
+import settings
+
+wsgi_app = 'app:app'
+bind = getattr(settings, 'server_bind', '0.0.0.0:8080')
+
+# Webhooks are answered right away, so a few threaded workers go a long way;
+# the analysis itself runs on the job queue threads of each worker
+workers = getattr(settings, 'server_workers', min(4, multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = getattr(settings, 'server_threads', 8)
+
+preload_app = True
+
+
+# updates the webhook once, from the master process, without holding up the
+# workers
+def when_ready(server):
+    import app
+    app.configure_logging()
+    app.register_webhook_in_background()
+    app.report_startup()
+
+
+def post_fork(server, worker):
+    import app
+    app.init_worker()
@@ -14,3 +14,162 @@ webhook_name = "your_webhook_name"
 # Launch ngrok, e.g., ./ngrok http 8080
 # Modify the ngrok url below if ngrok is not running on localhost
 ngrok_url = "http://localhost:4040/api/tunnels"
+
+# Webhooks are acknowledged immediately and analysed by a pool of worker
+# threads. Webhooks arriving while job_queue_size jobs are already waiting
+# are answered with 503 so Spark retries them later.
+worker_threads = 4
+job_queue_size = 100
+
+# Analysis results are cached by image content or URL, so re-posted images
+# skip Google Vision. Set result_cache_dir to a directory to keep the cache
+# across restarts, otherwise it is kept in memory.
+result_cache_size = 1000
+result_cache_ttl = 24 * 3600
+result_cache_dir = None
+
+# Spark REST API calls share a pool of keep-alive connections. Failed calls
+# and rate limited (429) calls are retried with a backoff.
+spark_api_url = "https://api.ciscospark.com/v1"
+spark_timeout = 10
+spark_retries = 3
+spark_backoff = 0.5
+spark_pool_size = 10
+
+# Results are packed into as few Spark messages as the markdown size limit
+# allows. With streaming messages, the first message is posted right away
+# and edited as more results become available.
+spark_max_message_bytes = 7439
+spark_streaming_messages = False
+
+# Images wider than base_img_width are downscaled before analysis and
+# re-encoded to fit in image_byte_budget bytes. Downscaling by more than
+# fast_resample_scale uses a cheaper resampling filter.
+image_byte_budget = 1024 * 1024
+jpeg_quality = 85
+fast_resample_scale = 0.25
+
+# All Vision features of an image are requested in one call. Set
+# vision_batch_requests to False to send one call per feature instead, run
+# in parallel by vision_fanout_workers threads with a vision_timeout
+# seconds deadline. By default there are enough threads for every feature
+# of every image being analysed at once.
+vision_batch_requests = True
+vision_fanout_workers = None
+vision_timeout = 30
+
+# Files or image URLs posted in a single message are analysed concurrently,
+# at most message_item_concurrency at a time.
+message_item_concurrency = 4
+
+# Webhook deliveries of a message already handled within seen_messages_ttl
+# seconds are skipped. Set seen_messages_dir to a directory to remember
+# handled messages across restarts.
+seen_messages_size = 10000
+seen_messages_ttl = 3600
+seen_messages_dir = None
+
+# Message details fetched from Spark are reused for message_details_ttl
+# seconds.
+message_details_ttl = 60
+
+# Images posted as URLs are downloaded once and analysed from memory. Larger
+# or slower downloads than these limits are abandoned.
+url_max_bytes = 20 * 1024 * 1024
+url_timeout = 10
+
+# Files posted to a room are streamed, and given up once larger than
+# file_max_bytes. Images of more than image_max_pixels pixels are refused
+# before being decoded. The bitmaps of the images being decoded and resized
+# by a worker process hold image_memory_budget bytes at most, images that do
+# not fit wait for their turn (None means no limit).
+file_max_bytes = 50 * 1024 * 1024
+image_max_pixels = 50 * 1000 * 1000
+image_memory_budget = 512 * 1024 * 1024
+
+# Features analysed when a room has no profile and a message names none.
+# Rooms choose their own with "@GoogleVision profile text macs", saved in
+# room_profiles_path (set it to None to keep profiles in memory only).
+default_features = ('web', 'text', 'faces', 'labels', 'landmarks', 'logos', 'macs')
+room_profiles_path = "room_profiles.json"
+
+# Commands are the words right after the mention of the Bot, by its display
+# name in Spark, or at the start of the message in 1-1 rooms.
+bot_name = "GoogleVision"
+
+# Production server (gunicorn -c gunicorn.conf.py) address, worker processes
+# and threads per worker. With several workers, set seen_messages_dir so
+# duplicate deliveries are detected across workers.
+server_bind = "0.0.0.0:8080"
+server_workers = 4
+server_threads = 8
+
+# asyncio variant (python async_app.py): at most async_max_jobs webhooks are
+# analysed at once and async_queue_size more may wait before webhooks are
+# answered with 503. Google Vision calls and resizing run on
+# async_executor_threads threads, Spark and image downloads share
+# async_connections connections.
+async_max_jobs = 200
+async_queue_size = 1000
+async_executor_threads = 32
+async_connections = 100
+
+# Quotas of the external APIs, for each worker process. At most vision_rate
+# Google Vision calls per second are made on average, in bursts of up to
+# vision_burst, with at most vision_max_concurrency calls in flight (None as
+# a rate means no limit). The number of calls in flight is halved whenever
+# an API answers that its quota is exhausted and grows back as calls
+# succeed. Calls wait up to rate_limit_max_wait seconds for their turn
+# before being dropped, and Spark's Retry-After delays are capped at it.
+# Vision calls refused over the quota are retried vision_quota_retries
+# times, waiting vision_quota_backoff seconds, then twice as long each time.
+vision_rate = 30
+vision_burst = 30
+vision_max_concurrency = 16
+vision_quota_retries = 3
+vision_quota_backoff = 1.0
+spark_rate = None
+spark_burst = 10
+spark_max_concurrency = 10
+rate_limit_max_wait = 30
+
+# Set image_hash_distance, e.g. to 4, to let images within that many bits
+# (out of 64) of the perceptual hash of an image analysed before, e.g. the
+# same photo at another size, reuse its web, labels, landmarks and logos
+# results. Google Vision is then only asked for the other features, such as
+# text and MAC addresses, which can differ between images that look alike.
+# Up to image_hash_size hashes are kept, and saved to image_hash_path when
+# set. None only reuses results of identical images.
+image_hash_distance = None
+image_hash_size = 100000
+image_hash_path = None
+
+# Post a short summary of each analysis, with the top result_summary_items
+# items of every feature, instead of the full results. None posts them all.
+result_summary_items = None
+
+# Caps on the results of each feature, applied both to the Google Vision
+# request and to the results posted: max_results items at most (for text,
+# words besides the full text, which Vision always returns), only entities
+# scoring min_score or more, and whether to include the bounding polygons
+# of text and faces. An empty dict posts everything Vision returns.
+feature_limits = {
+    'web': {'max_results': 10, 'min_score': 0.0},
+    'text': {'max_results': 50, 'bounds': False},
+    'faces': {'max_results': 10, 'bounds': True},
+    'labels': {'max_results': 10, 'min_score': 0.5},
+    'landmarks': {'max_results': 5, 'min_score': 0.0},
+    'logos': {'max_results': 5, 'min_score': 0.0},
+}
+
+# Log level of the application, e.g. "DEBUG" to trace every processing stage
+log_level = "INFO"
+
+# The Spark webhook is pointed at the ngrok tunnel of ngrok_proto ("http" or
+# "https") in the background while the application starts. Failed updates,
+# e.g. while ngrok is still starting, are retried webhook_retries times,
+# waiting webhook_backoff seconds, then twice as long each time (a minute at
+# most).
+ngrok_proto = "http"
+webhook_retries = 10
+webhook_backoff = 2.0
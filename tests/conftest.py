@@ -0,0 +1,10 @@
+import importlib.util
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app.py reads settings.py, the placeholders of the template will do
+if importlib.util.find_spec('settings') is None:
+    import settings_template
+    sys.modules['settings'] = settings_template
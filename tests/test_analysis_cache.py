@@ -0,0 +1,103 @@
+import time
+from concurrent import futures
+
+import pytest
+
+import app
+
+
+# stands in for Google Vision, answering with the responses given in turn
+def fake_vision(monkeypatch, responses):
+    calls = []
+
+    def annotate_image(image, features, deadline=None):
+        calls.append(features)
+        return responses[min(len(calls), len(responses)) - 1]
+
+    monkeypatch.setattr(app, 'annotate_image', annotate_image)
+    monkeypatch.setattr(app, 'results', app.ResultCache(10, 3600))
+    return calls
+
+
+def labels_response(*labels):
+    response = app.types.AnnotateImageResponse()
+    for label in labels:
+        response.label_annotations.add(description=label, score=0.9)
+    return response
+
+
+def test_vision_errors_are_not_cached(monkeypatch):
+    failed = app.types.AnnotateImageResponse()
+    failed.error.message = 'Bad image data'
+    calls = fake_vision(monkeypatch, [failed, labels_response('router')])
+    image = app.types.Image(content=b'image')
+
+    assert app.analyze_image_cached(image, ('labels',)).error == 'Bad image data'
+    result = app.analyze_image_cached(image, ('labels',))
+    assert [label.description for label in result.labels] == ['router']
+    assert result.error is None
+    assert len(calls) == 2
+
+    app.analyze_image_cached(image, ('labels',))
+    assert len(calls) == 2
+
+
+def test_partial_results_are_not_cached(monkeypatch):
+    slow = set(['labels'])
+
+    def annotate_image(image, features, deadline=None):
+        if features[0] in slow:
+            slow.clear()
+            raise RuntimeError('deadline exceeded')
+        return labels_response('router')
+
+    monkeypatch.setattr(app, 'vision_batch_requests', False)
+    fake_vision(monkeypatch, [])
+    monkeypatch.setattr(app, 'annotate_image', annotate_image)
+    image = app.types.Image(content=b'image')
+
+    result = app.analyze_image_cached(image, ('labels',))
+    assert result.labels == [] and 'labels' in result.error
+    result = app.analyze_image_cached(image, ('labels',))
+    assert [label.description for label in result.labels] == ['router']
+    assert result.error is None
+
+
+def test_fanned_out_calls_still_queued_at_the_deadline_are_cancelled(monkeypatch):
+    calls = []
+
+    def annotate_image(image, features, deadline=None):
+        calls.append((features[0], app.trace.message_id, deadline))
+        time.sleep(0.2)
+        return labels_response('router')
+
+    monkeypatch.setattr(app, 'annotate_image', annotate_image)
+    monkeypatch.setattr(app, 'vision_fanout', futures.ThreadPoolExecutor(max_workers=1))
+    app.trace.message_id = 'msg-1'
+    started = time.time()
+
+    response = app.annotate_image_concurrently(app.types.Image(content=b'image'), ('labels', 'logos'), 0.1)
+    app.vision_fanout.shutdown(wait=True)
+
+    assert response.error.message == 'Vision labels, logos detection did not complete'
+    assert [(feature, message_id) for feature, message_id, _ in calls] == [('labels', 'msg-1')]
+    assert calls[0][2] == pytest.approx(started + 0.1, abs=0.05)
+
+
+def test_similar_images_only_reuse_features_that_survive_rescaling(monkeypatch):
+    def label_photo(mac):
+        response = labels_response('router')
+        response.text_annotations.add(description='MAC ' + mac)
+        return response
+
+    calls = fake_vision(monkeypatch, [label_photo('00:1A:2B:3C:4D:5E'), label_photo('F4:CF:E2:99:10:A7')])
+    monkeypatch.setattr(app, 'image_hashes', app.ImageHashIndex(100, 4))
+    features = ('text', 'labels', 'macs')
+
+    first = app.analyze_image_similar(b'first photo', 0b1011, features)
+    second = app.analyze_image_similar(b'second photo', 0b1010, features)
+
+    assert calls == [['text', 'labels'], ['text']]
+    assert first.macs == ['00:1a:2b:3c:4d:5e']
+    assert second.macs == ['f4:cf:e2:99:10:a7']
+    assert [label.description for label in second.labels] == ['router']
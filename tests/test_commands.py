@@ -0,0 +1,48 @@
+from concurrent import futures
+
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('text, features', [
+    ('text macs https://example.com/label.jpg', ('text', 'macs')),
+    ('GoogleVision labels logos', ('labels', 'logos')),
+    ('@GoogleVision all', app.all_features),
+    ('Hey GoogleVision faces please', ('faces',)),
+    ('Can you read the text on this label? https://example.com/label.jpg', None),
+    ('is that all?', None),
+    ('https://example.com/text.jpg', None),
+])
+def test_parse_features(text, features):
+    assert app.parse_features(text) == features
+
+
+@pytest.mark.parametrize('text', [
+    'my new profile picture https://example.com/me.jpg',
+    'GoogleVision what is in my profile picture?',
+    'text profile',
+])
+def test_profile_command_needs_profile_first(text):
+    assert app.profile_command('room', text) is None
+
+
+@pytest.mark.parametrize('text, urls, reply', [
+    ('labels https://example.com/a.jpg', ['https://example.com/a.jpg'], None),
+    ('help', [], app.help_msg),
+    ('?', [], app.help_msg),
+    ('help with https://example.com/a.jpg', ['https://example.com/a.jpg'], None),
+    ('hello', [], None),
+])
+def test_read_message(text, urls, reply):
+    assert app.read_message('room', text) == (urls, reply)
+
+
+def test_files_use_the_room_profile_when_the_message_cannot_be_fetched():
+    failed = futures.Future()
+    failed.set_exception(OSError('reset'))
+    fetched = futures.Future()
+    fetched.set_result({'text': 'GoogleVision logos'})
+
+    assert app.file_features('message', 'room', failed) == app.profiles.get('room')
+    assert app.file_features('message', 'room', fetched) == ('logos',)
@@ -0,0 +1,34 @@
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('text', [
+    '00:1A:2B:3C:4D:5E',
+    '00-1a-2b-3c-4d-5e',
+    '001A.2B3C.4D5E',
+    '001A2B3C4D5E',
+    'MAC:00:1A:2B:3C:4D:5E',
+    'MAC:001A2B3C4D5E',
+    'ETH-MAC:001A.2B3C.4D5E',
+    'mac-00-1A-2B-3C-4D-5E',
+    'S/N 12345 MAC 00:1A:2B:3C:4D:5E rev B',
+])
+def test_finds_mac_addresses(text):
+    assert app.extract_mac_addresses(text) == ['00:1a:2b:3c:4d:5e']
+
+
+@pytest.mark.parametrize('text', [
+    '00:1A:2B:3C:4D:5E:6F',
+    'AB:00:1A:2B:3C:4D:5E',
+    '0011.2233.4455.6677',
+    '001A2B3C4D5E6F',
+    'serial 9001A2B3C4D5E',
+])
+def test_ignores_longer_sequences(text):
+    assert app.extract_mac_addresses(text) == []
+
+
+def test_distinct_in_order():
+    text = 'eth0 F4:CF:E2:99:10:A7\neth1 00:1A:2B:3C:4D:5E\nf4cf.e299.10a7'
+    assert app.extract_mac_addresses(text) == ['f4:cf:e2:99:10:a7', '00:1a:2b:3c:4d:5e']
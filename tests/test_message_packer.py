@@ -0,0 +1,48 @@
+import asyncio
+import json
+
+import pytest
+
+async_app = pytest.importorskip('async_app')
+
+
+class FakeSpark(object):
+    def __init__(self):
+        self.calls = []
+
+    async def post_message(self, roomId, msg):
+        self.calls.append(('post', msg))
+        return async_app.SparkResponse(200, {}, json.dumps({'id': 'm{}'.format(len(self.calls))}).encode('utf-8'))
+
+    async def edit_message(self, msgId, roomId, msg):
+        self.calls.append(('edit ' + msgId, msg))
+
+
+def test_streaming_posts_then_edits_each_message(monkeypatch):
+    spark = FakeSpark()
+    monkeypatch.setattr(async_app, 'spark', spark)
+    packer = async_app.MessagePacker(10, streaming=True)
+
+    async def post(*texts):
+        for text in texts:
+            packer.add(text)
+        await async_app.post_messages('room', packer.take())
+
+    async def run():
+        await post('one')
+        await post('two', 'xx')
+        await post('three')
+        packer.close()
+        await async_app.post_messages('room', packer.take())
+    asyncio.run(run())
+
+    assert spark.calls == [('post', 'one'), ('edit m1', 'one\n\ntwo'),
+                           ('post', 'xx'), ('edit m3', 'xx\n\nthree')]
+
+
+def test_messages_are_posted_once_full():
+    packer = async_app.MessagePacker(10)
+    for text in ('one', 'two', 'three'):
+        packer.add(text)
+    packer.close()
+    assert [text for _, text in packer.take()] == ['one\n\ntwo', 'three']
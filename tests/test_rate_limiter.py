@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+
+import app
+
+async_app = pytest.importorskip('async_app')
+
+
+def test_cancelled_acquire_keeps_the_limit():
+    limiter = app.RateLimiter('spark', None, 10, 1, 5)
+    limiter.acquire()
+
+    async def cancel_waiting_call():
+        waiting = asyncio.ensure_future(async_app.acquire(limiter))
+        await asyncio.sleep(0.1)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+
+    asyncio.run(cancel_waiting_call())
+    limiter.release()
+    assert limiter.stats()['in_flight'] == 0
+
+    asyncio.run(async_app.acquire(limiter))
+    assert limiter.stats()['in_flight'] == 1
+
+
+def test_acquire_waits_for_tokens():
+    limiter = app.RateLimiter('vision', 20, 1, 10, 5)
+    limiter.acquire()
+    limiter.release()
+    asyncio.run(async_app.acquire(limiter))
+    assert limiter.stats()['throttled'] == 1
+
+
+def test_acquire_drops_calls_after_max_wait():
+    limiter = app.RateLimiter('spark', None, 10, 1, 0.1)
+    limiter.acquire()
+    with pytest.raises(app.RateLimited):
+        asyncio.run(async_app.acquire(limiter))
+    assert limiter.stats()['dropped'] == 1
@@ -0,0 +1,38 @@
+import io
+
+import pytest
+from PIL import Image, ImageDraw
+
+import app
+
+
+def test_transparent_images_are_flattened_on_white(monkeypatch):
+    monkeypatch.setattr(app, 'image_byte_budget', 1000)
+    img = Image.new('RGBA', (800, 400), (0, 0, 0, 0))
+    ImageDraw.Draw(img).rectangle((100, 100, 300, 300), fill=(0, 0, 0, 255))
+    content = io.BytesIO()
+    img.save(content, format='PNG')
+
+    resized = Image.open(io.BytesIO(app.resize_image(content.getvalue(), 1024)))
+    assert resized.format == 'JPEG'
+    assert resized.convert('L').getpixel((10, 10)) > 240
+    assert resized.convert('L').getpixel((200, 200)) < 15
+
+
+def test_images_over_the_pixel_limit_are_not_decoded(monkeypatch):
+    monkeypatch.setattr(app, 'image_max_pixels', 1000)
+    content = io.BytesIO()
+    Image.new('RGB', (100, 100)).save(content, format='PNG')
+    with pytest.raises(app.ImageTooLarge):
+        app.resize_image(content.getvalue(), 1024)
+
+
+def test_images_over_the_limits_are_not_dependency_errors(monkeypatch):
+    monkeypatch.setattr(app, 'metrics', app.Metrics('test'))
+    with pytest.raises(app.ImageTooLarge):
+        with app.timed('download_body', 'spark'):
+            raise app.ImageTooLarge('too large')
+    with pytest.raises(OSError):
+        with app.timed('download_body', 'spark'):
+            raise OSError('reset')
+    assert app.metrics.counters == {('dependency_errors_total', (('dependency', 'spark'),)): 1}
@@ -0,0 +1,35 @@
+import threading
+
+import app
+
+
+# caches of several worker processes sharing one directory evict each
+# other's files while adding their own
+def test_disk_caches_sharing_a_directory(tmp_path):
+    caches = [app.DiskResultCache(str(tmp_path), 20, 3600) for i in range(4)]
+    errors = []
+
+    def add(cache, worker):
+        try:
+            for i in range(300):
+                assert cache.add('message-{}-{}'.format(worker, i), 1)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=add, args=(cache, worker)) for worker, cache in enumerate(caches)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+
+
+def test_disk_cache_evicts_oldest_entries(tmp_path):
+    cache = app.DiskResultCache(str(tmp_path), 50, 3600)
+    for i in range(200):
+        cache.set('result-{}'.format(i), i)
+
+    assert len(cache.files()) <= 55
+    assert cache.get('result-199') == 199
+    assert cache.get('result-0') is None
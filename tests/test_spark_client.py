@@ -0,0 +1,105 @@
+import collections
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import app
+
+
+class SlowSpark(BaseHTTPRequestHandler):
+    calls = collections.Counter()
+    delay = 0.0
+    status = 200
+    headers_out = {}
+    hang_up = False
+
+    def answer(self):
+        self.calls[self.command] += 1
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        time.sleep(self.delay)
+        if self.hang_up:
+            self.close_connection = True
+            return
+        try:
+            self.send_response(self.status)
+            for name, value in self.headers_out.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+        except OSError:
+            pass
+
+    do_GET = do_POST = answer
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def spark(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowSpark)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    SlowSpark.calls.clear()
+    monkeypatch.setattr(app, 'spark_backoff', 0.01)
+    yield app.SparkClient('token', 'http://127.0.0.1:{}'.format(server.server_port), 0.2, 2, 2)
+    server.shutdown()
+
+
+def test_post_is_not_retried_after_a_read_timeout(spark, monkeypatch):
+    monkeypatch.setattr(SlowSpark, 'delay', 0.5)
+    with pytest.raises(requests.Timeout):
+        spark.request('POST', '/messages', json={'markdown': 'hello'})
+    assert SlowSpark.calls['POST'] == 1
+
+
+def test_post_is_not_retried_after_a_bad_gateway(spark, monkeypatch):
+    monkeypatch.setattr(SlowSpark, 'status', 502)
+    assert spark.request('POST', '/messages', json={'markdown': 'hello'}).status_code == 502
+    assert SlowSpark.calls['POST'] == 1
+
+
+def test_post_is_retried_when_busy(spark, monkeypatch):
+    monkeypatch.setattr(SlowSpark, 'status', 503)
+    spark.request('POST', '/messages', json={'markdown': 'hello'})
+    assert SlowSpark.calls['POST'] == 3
+
+
+def test_get_is_retried_after_a_read_timeout(spark, monkeypatch):
+    monkeypatch.setattr(SlowSpark, 'delay', 0.5)
+    with pytest.raises(requests.Timeout):
+        spark.request('GET', '/messages/1')
+    assert SlowSpark.calls['GET'] == 3
+
+
+def test_post_is_not_retried_after_the_connection_drops(spark, monkeypatch):
+    monkeypatch.setattr(SlowSpark, 'hang_up', True)
+    with pytest.raises(requests.ConnectionError):
+        spark.request('POST', '/messages', json={'markdown': 'hello'})
+    assert SlowSpark.calls['POST'] == 1
+
+
+def test_post_is_retried_when_the_connection_is_refused(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(app.time, 'sleep', sleeps.append)
+    with socket.socket() as unused:
+        unused.bind(('127.0.0.1', 0))
+        port = unused.getsockname()[1]
+    client = app.SparkClient('token', 'http://127.0.0.1:{}'.format(port), 0.2, 2, 2)
+    with pytest.raises(requests.ConnectionError):
+        client.request('POST', '/messages', json={'markdown': 'hello'})
+    assert len(sleeps) == 2
+
+
+def test_retry_after_is_capped(spark, monkeypatch):
+    monkeypatch.setattr(app, 'rate_limit_max_wait', 1)
+    monkeypatch.setattr(SlowSpark, 'headers_out', {'Retry-After': '3600'})
+    monkeypatch.setattr(SlowSpark, 'status', 429)
+    response = spark.session.get(spark.base_url + '/messages')
+    assert spark.retry_delay(response, 0) == 1